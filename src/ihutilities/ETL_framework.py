@@ -3,53 +3,74 @@
 
 import csv
 import datetime
+import locale
 import logging
+import operator
 import os
+import pickle
+import re
+import sqlite3
 import sys
+import tempfile
 import time
 
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 from ihutilities import (
     configure_db,
+    open_db,
+    close_db,
     write_to_db,
     update_to_db,
     read_db,
+    read_db_scalar,
     calculate_file_sha,
     _normalise_config,
     check_mysql_database_exists,
+    check_table_exists,
     get_a_file_handle,
     split_zipfile_path,
 )
+from ihutilities.db_utils import MEMORY_DB_PATH
 
 # This dictionary has field names and field types. It should be reuseable between the configure_db
 # and write_to_db functions
 
-metadata_fields = OrderedDict(
-    [
-        ("SequenceNumber", "INTEGER PRIMARY KEY"),
-        ("data_path", "TEXT"),
-        ("datafile_sha", "TEXT"),
-        ("status", "TEXT"),
-        ("start_time", "TEXT"),
-        ("finish_time", "TEXT"),
-        ("last_write_time", "TEXT"),
-        ("chunk_count", "INTEGER"),
-    ]
-)
+metadata_fields = {
+    "SequenceNumber": "INTEGER PRIMARY KEY",
+    "data_path": "TEXT",
+    "datafile_sha": "TEXT",
+    "status": "TEXT",
+    "start_time": "TEXT",
+    "finish_time": "TEXT",
+    "last_write_time": "TEXT",
+    "chunk_count": "INTEGER",
+}
 
-session_log_fields = OrderedDict(
-    [
-        ("ID", "INTEGER PRIMARY KEY"),
-        ("make_row_method", "TEXT"),
-        ("start_time", "TEXT"),
-        ("end_time", "TEXT"),
-        ("datafile_sha", "TEXT"),
-        ("first_chunk", "TEXT"),
-        ("last_chunk", "FLOAT"),
-    ]
-)
+session_log_fields = {
+    "ID": "INTEGER PRIMARY KEY",
+    "make_row_method": "TEXT",
+    "start_time": "TEXT",
+    "end_time": "TEXT",
+    "datafile_sha": "TEXT",
+    "first_chunk": "TEXT",
+    "last_chunk": "FLOAT",
+}
+
+
+_POINT_FORMAT = "POINT({} {})".format
 
+# Input files are read through a 1MiB buffer
+SOURCE_BUFFER_SIZE = 1 << 20
+
+# do_etl_many's worker processes hand parsed rows back through a temporary file in chunks of
+# this many rows
+PARSED_CHUNK_SIZE = 10_000
+
+# An empty line, which _dict_rows skips, found by the newline ending the line before it
+BLANK_LINE = re.compile(rb"(?<=\n)\r?\n")
 
 logger = logging.getLogger(__name__)
 
@@ -57,7 +78,9 @@ logger = logging.getLogger(__name__)
 def make_row(
     input_row, data_path, data_field_lookup, db_fields, null_equivalents, autoinc, primary_key
 ):
-    new_row = OrderedDict([(x, None) for x in db_fields.keys()])
+    # This is left as a direct implementation since custom rowmakers call it for every row,
+    # do_etl uses compile_rowmaker to resolve the lookups once when make_row is the rowmaker
+    new_row = {x: None for x in db_fields.keys()}
     # zip input row into output row
     for output_key in new_row.keys():
         # This inserts blank fields
@@ -98,16 +121,125 @@ def make_row(
     return new_row
 
 
+def make_row_factory(data_field_lookup, db_fields, null_equivalents, autoinc, primary_key):
+    """This function returns a function equivalent to make_row for one set of db_fields and
+    lookups, so the work of resolving them is done once rather than for every input row
+
+    Args:
+       As for make_row
+
+    Returns:
+       rowmaker (function):
+            rowmaker(input_row) returns a dictionary keyed by db_fields, or None if the
+            input row is malformed
+    """
+    compiled_rowmaker = compile_rowmaker(
+        db_fields, data_field_lookup, null_equivalents, autoinc, primary_key
+    )
+    dst_keys = tuple(db_fields)
+
+    def rowmaker(input_row):
+        values = compiled_rowmaker(input_row)
+        if values is None:
+            return None
+        return dict(zip(dst_keys, values))
+
+    return rowmaker
+
+
+def compile_rowmaker(db_fields, data_field_lookup, null_equivalents, autoinc, primary_key):
+    """This function builds a rowmaker specialised to a particular set of db_fields and lookups
+
+    Args:
+       db_fields (dict):
+            A dictionary of fieldnames and types for the output table
+       data_field_lookup (dict):
+            A dictionary linking database fields (as the key) to CSV columns (the value)
+       null_equivalents (list of strings):
+            cell contents which should be considered equivalent of null i.e ["-"]
+       autoinc (bool):
+            True if the primary key is a synthetic autoincrement key
+       primary_key (str):
+            the name of the primary key field
+
+    Returns:
+       rowmaker (function):
+            a function which takes an input data row and returns a tuple of values in db_fields
+            order, or None if the input row is malformed
+
+    """
+    # The field lookups and types are resolved once here rather than for every input row
+    null_set = frozenset(null_equivalents)
+    plan = []
+    for output_key, field_type in db_fields.items():
+        lookup = data_field_lookup[output_key]
+        if autoinc and output_key == primary_key:
+            kind = "autoinc"
+        elif lookup is None:
+            kind = "blank"
+        elif field_type == "POINT":
+            kind = "point"
+            lookup = operator.itemgetter(lookup[0], lookup[1])
+        elif isinstance(lookup, list):
+            kind = "blank"
+        elif field_type.lower() == "integer":
+            kind = "integer"
+        else:
+            kind = "value"
+        plan.append((kind, lookup))
+
+    def rowmaker(input_row):
+        values = []
+        for kind, lookup in plan:
+            if kind == "autoinc" or kind == "blank":
+                values.append(None)
+                continue
+            if kind == "point":
+                values.append(_format_point(*lookup(input_row)))
+                continue
+            try:
+                value = input_row[lookup]
+            except IndexError:
+                logger.warning(
+                    "Required element number '{}' not found in input data list = {}".format(
+                        lookup, input_row
+                    )
+                )
+                return None
+            except KeyError:
+                logger.warning(
+                    "Required data field '{}' not found in input data = {}".format(
+                        lookup, input_row
+                    )
+                )
+                raise
+            try:
+                is_null = value in null_set
+            except TypeError:
+                # Unhashable values, such as the list of surplus cells _dict_rows keys on None
+                is_null = value in null_equivalents
+            if is_null:
+                value = None
+            # If output_key corresponds to an INTEGER then remove any commas in input
+            elif kind == "integer" and isinstance(value, str):
+                value = int(float(value.replace(",", "")))
+            values.append(value)
+
+        return tuple(values)
+
+    return rowmaker
+
+
 def get_source_generator(data_path, headers, separator, encoding):
     # See data manager for detecting zip files, and then picking up the right part
     #
-    fh = get_a_file_handle(data_path, encoding=encoding)
+    fh = get_a_file_handle(data_path, encoding=encoding, buffering=SOURCE_BUFFER_SIZE, newline="")
     if fh is None:
         logger.critical("No file handle for {}".format(data_path))
 
     with fh:
         if headers:
-            rows = csv.DictReader(fh, delimiter=separator)
+            rows = _dict_rows(csv.reader(fh, delimiter=separator))
         else:
             # This handles a creditsafe instance where the delimiter was | and
             # there was an instance of an unbalanced "
@@ -120,6 +252,29 @@ def get_source_generator(data_path, headers, separator, encoding):
             yield row
 
 
+def _dict_rows(reader):
+    # This behaves like csv.DictReader but only pays for the row length checks on ragged rows
+    fieldnames = next(reader, None)
+    if fieldnames is None:
+        return
+    n_fields = len(fieldnames)
+
+    for row in reader:
+        if len(row) == n_fields:
+            yield dict(zip(fieldnames, row))
+        elif len(row) == 0:
+            continue
+        else:
+            new_row = dict(zip(fieldnames, row))
+            if len(row) > n_fields:
+                new_row[None] = row[n_fields:]
+            else:
+                n_cells = len(row)
+                for key in fieldnames[n_cells:]:
+                    new_row[key] = None
+            yield new_row
+
+
 def do_etl(
     db_fields,
     db_config,
@@ -138,6 +293,8 @@ def do_etl(
     chunk_size=None,
     skip=None,
     chaos_monkey=False,
+    sha_algorithm="sha1",
+    csv_extension=None,
 ):
     """This function uploads CSV files to a sqlite or MariaDB/MySQL database
 
@@ -184,6 +341,14 @@ def do_etl(
             the rowsource function yields input data rows which are handed off to the rowmaker
             to make database rows. The function call is:
             get_source_generator(data_path, headers, separator, encoding)
+       sha_algorithm (str):
+            the hashlib algorithm used to fingerprint the input file, files already uploaded
+            are only recognised if the same algorithm is used
+       csv_extension (str):
+            path to sqlite's csv loadable extension. If given, and the input is a plain comma
+            separated sqlite upload needing no conversion of its fields, the file is loaded
+            with the extension's csv virtual table rather than row by row in Python. Falls back
+            to the usual route if the extension can't be loaded
 
     Return:
        db_config (dict):
@@ -246,7 +411,7 @@ def do_etl(
 
     logger.info("Calculating file sha...")
     t0 = time.time()
-    datafile_sha = calculate_file_sha(data_path, encoding=encoding)
+    datafile_sha = calculate_file_sha(data_path, encoding=encoding, algorithm=sha_algorithm)
     if datafile_sha is None:
         datafile_sha = rowsource.__name__
     t1 = time.time()
@@ -286,339 +451,650 @@ def do_etl(
 
     configure_db(db_config, revised_db_fields, tables=tables, force=force)
 
-    # Get on with the main business
-    t0 = time.time()
-    data = []
-    line_count = 0
-    lines_dropped = 0
-    malformed_lines = 0
-
-    primary_key_set = set()
-    duplicate_primary_keys = set()
-    primary_key = get_primary_key_from_db_fields(revised_db_fields[table])
-
-    if primary_key == "ID" and data_field_lookup["ID"] is None:
-        autoinc = True
-    else:
-        autoinc = False
-
-    #
+    # Hold one connection open for all of the chunked writes rather than reconnecting for each,
+    # unless the caller is already holding one open
+    keep_connection = db_config.get("db_keep_open")
+    if not keep_connection:
+        db_config = open_db(db_config)
 
-    # Find out if we have already uploaded this file
-    sql_query = (
-        "select * from metadata where datafile_sha = '{}' order by SequenceNumber desc;".format(
-            datafile_sha
-        )
-    )
+    try:
+        # Get on with the main business
+        t0 = time.time()
+        data = []
+        line_count = 0
+        lines_dropped = 0
+        malformed_lines = 0
 
-    results = list(read_db(sql_query, db_config))
+        primary_key_set = set()
+        duplicate_primary_keys = set()
+        primary_key = get_primary_key_from_db_fields(revised_db_fields[table])
 
-    if len(results) == 0:
-        # Write start to metadata table
-        last_id = get_current_sequencenumber(db_config)
-        if last_id is None:
-            id_ = 1
+        if primary_key == "ID" and data_field_lookup["ID"] is None:
+            autoinc = True
         else:
-            id_ = last_id + 1
-        start_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # metadata = [(id_, data_path, datafile_sha,"Started", start_time, "", "", 0)]
+            autoinc = False
+
+        # The default rowmaker is specialised to the fields once, and makes tuples rather than dicts
+        # so the primary key is then looked up by position
+        compiled_rowmaker = None
+        primary_key_lookup = primary_key
+        if rowmaker is make_row:
+            compiled_rowmaker = compile_rowmaker(
+                revised_db_fields[table], data_field_lookup, null_equivalents, autoinc, primary_key
+            )
+            if primary_key is not None:
+                primary_key_lookup = list(revised_db_fields[table].keys()).index(primary_key)
 
-        metadata = [
-            OrderedDict(
-                [
-                    ("SequenceNumber", id_),
-                    ("data_path", data_path),
-                    ("datafile_sha", datafile_sha),
-                    ("status", "Started"),
-                    ("start_time", start_time),
-                    ("finish_time", ""),
-                    ("last_write_time", ""),
-                    ("chunk_count", 0),
-                ]
+        #
+
+        # Find out if we have already uploaded this file
+        sql_query = (
+            "select * from metadata where datafile_sha = '{}' order by SequenceNumber desc;".format(
+                datafile_sha
             )
-        ]
+        )
 
-        write_to_db(metadata, db_config, revised_db_fields["metadata"], table="metadata")
         results = list(read_db(sql_query, db_config))
-        id_ = results[0]["SequenceNumber"]
-    else:
-        id_ = results[0]["SequenceNumber"]
-        start_time = results[0]["start_time"]
-
-    # print(id_, start_time, flush=True)
 
-    # ** Add in session log code
-    # Fetch chunk progress
-    if skip is None:
-        chunk_skip = get_chunk_count(id_, datafile_sha, db_config)
-    else:
-        chunk_skip = skip
+        if len(results) == 0:
+            # Write start to metadata table
+            last_id = get_current_sequencenumber(db_config)
+            if last_id is None:
+                id_ = 1
+            else:
+                id_ = last_id + 1
+            start_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            # metadata = [(id_, data_path, datafile_sha,"Started", start_time, "", "", 0)]
+
+            metadata = [
+                {
+                    "SequenceNumber": id_,
+                    "data_path": data_path,
+                    "datafile_sha": datafile_sha,
+                    "status": "Started",
+                    "start_time": start_time,
+                    "finish_time": "",
+                    "last_write_time": "",
+                    "chunk_count": 0,
+                }
+            ]
 
-    chunk_count = chunk_skip
-    if chunk_skip != 0:
-        line_count_offset = chunk_size * chunk_skip
-        line_count = 0
-    else:
-        line_count_offset = 0
-        line_count = 0
+            write_to_db(metadata, db_config, revised_db_fields["metadata"], table="metadata")
+            results = list(read_db(sql_query, db_config))
+            id_ = results[0]["SequenceNumber"]
+        else:
+            id_ = results[0]["SequenceNumber"]
+            start_time = results[0]["start_time"]
 
-    logging.info("Skipping {} chunks ({} lines)".format(chunk_skip, line_count_offset))
-    # # ** Skip chunks
-    # key_chunks = key_method(chunk_size)
+        # print(id_, start_time, flush=True)
 
-    # Update session log here
-    time_ = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # ** Add in session log code
+        # Fetch chunk progress
+        if skip is None:
+            chunk_skip = get_chunk_count(id_, datafile_sha, db_config)
+        else:
+            chunk_skip = skip
 
-    # We need to get the latest sessid here rather than using autoincrement
-    sql_query = "select max(ID) as ID from session_log;"
+        chunk_count = chunk_skip
+        if chunk_skip != 0:
+            line_count_offset = chunk_size * chunk_skip
+            line_count = 0
+        else:
+            line_count_offset = 0
+            line_count = 0
 
-    results = list(read_db(sql_query, db_config))
+        logging.info("Skipping {} chunks ({} lines)".format(chunk_skip, line_count_offset))
+        # # ** Skip chunks
+        # key_chunks = key_method(chunk_size)
 
-    if len(results) > 0 and results[0]["ID"] is not None:
-        new_sessid = results[0]["ID"] + 1
-    else:
-        new_sessid = 1
-
-    # We need
-    session_log_data = [
-        OrderedDict(
-            [
-                ("ID", new_sessid),
-                ("make_row_method", rowsource.__name__),
-                ("start_time", time_),
-                ("end_time", time_),
-                ("datafile_sha", datafile_sha),
-                ("first_chunk", chunk_skip),
-                ("last_chunk", chunk_skip),
-            ]
-        )
-    ]
+        # Update session log here
+        time_ = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    write_to_db(session_log_data, db_config, revised_db_fields["session_log"], table="session_log")
-    # Pick up session log data
-    sql_query = "select * from session_log where datafile_sha = '{}' order by ID desc;".format(
-        datafile_sha
-    )
-    results = list(read_db(sql_query, db_config))
-    sessid = results[0]["ID"]
+        # We need to get the latest sessid here rather than using autoincrement
+        sql_query = "select max(ID) as ID from session_log;"
 
-    # **End session log code
+        last_sessid = read_db_scalar(sql_query, db_config)
 
-    rows = rowsource(data_path, headers, separator, encoding)
-    # Loop over input rows
-    try:
-        for i, row in enumerate(rows):
-            if mode == "test" and chaos_monkey and (i > chunk_size + 1):
-                logger.critical(
-                    "Chaos monkey invoked, hitting exit at input file line {}".format(i)
-                )
-                logger.critical(
-                    "If you don't want this to happen don't set chaos_monkey=True in do_etl!"
-                )
-                return db_config, "Chaos monkey invoked"
-            # Line skipping code goes here
-            if i < line_count_offset:
-                if (i % chunk_size) == 0:
-                    print(
-                        "Skipping chunk {:.0f}, line = ({:d})".format(i / chunk_size, i),
-                        flush=True,
-                        end="\r",
-                    )
-                continue
+        if last_sessid is not None:
+            new_sessid = last_sessid + 1
+        else:
+            new_sessid = 1
+
+        # We need
+        session_log_data = [
+            {
+                "ID": new_sessid,
+                "make_row_method": rowsource.__name__,
+                "start_time": time_,
+                "end_time": time_,
+                "datafile_sha": datafile_sha,
+                "first_chunk": chunk_skip,
+                "last_chunk": chunk_skip,
+            }
+        ]
 
-            line_count += 1
-            # Zip the input data into a row for the database
-            new_rows = rowmaker(
-                row,
-                data_path,
-                data_field_lookup,
+        write_to_db(
+            session_log_data, db_config, revised_db_fields["session_log"], table="session_log"
+        )
+        # Pick up session log data
+        sql_query = "select ID from session_log where datafile_sha = '{}' order by ID desc;".format(
+            datafile_sha
+        )
+        sessid = read_db_scalar(sql_query, db_config)
+
+        # **End session log code
+
+        fast_load = None
+        if (
+            csv_extension is not None
+            and db_config["db_type"] == "sqlite"
+            and mode == "production"
+            and rowmaker is make_row
+            and rowsource is get_source_generator
+            and headers
+            and separator == ","
+            and ".zip" not in data_path.lower()
+            and os.path.isfile(data_path)
+            and line_count_offset == 0
+        ):
+            fast_load = _fast_load_csv(
+                db_config["db_conn"],
+                csv_extension,
+                table,
                 revised_db_fields[table],
+                data_field_lookup,
                 null_equivalents,
                 autoinc,
                 primary_key,
+                data_path,
             )
 
-            # Drop a line if it is malformed
-            if new_rows is None:
-                logger.debug(
-                    "Dropped input line = {} because a valid row could not be made from it".format(
-                        row
+        if fast_load is not None:
+            line_count, lines_dropped = fast_load
+            rows = iter(())
+        else:
+            rows = rowsource(data_path, headers, separator, encoding)
+        # Loop over input rows
+        try:
+            for i, row in enumerate(rows):
+                if mode == "test" and chaos_monkey and (i > chunk_size + 1):
+                    logger.critical(
+                        "Chaos monkey invoked, hitting exit at input file line {}".format(i)
                     )
-                )
-                malformed_lines += 1
-                continue
+                    logger.critical(
+                        "If you don't want this to happen don't set chaos_monkey=True in do_etl!"
+                    )
+                    return db_config, "Chaos monkey invoked"
+                # Line skipping code goes here
+                if i < line_count_offset:
+                    if (i % chunk_size) == 0:
+                        print(
+                            "Skipping chunk {:.0f}, line = ({:d})".format(i / chunk_size, i),
+                            flush=True,
+                            end="\r",
+                        )
+                    continue
 
-            if not isinstance(new_rows, list):
-                new_rows = [new_rows]
-
-            # Drop row if it has a duplicate primary key
-
-            for new_row in new_rows:
-                if (
-                    autoinc
-                    or (primary_key is None)
-                    or (new_row[primary_key] not in primary_key_set)
-                ):
-                    # data.append(([x for x in new_row.values()]))
-                    data.append(new_row)
-                    if primary_key is not None:
-                        primary_key_set.add(new_row[primary_key])
+                line_count += 1
+                # Zip the input data into a row for the database
+                if compiled_rowmaker is not None:
+                    new_rows = compiled_rowmaker(row)
                 else:
-                    # print("UPRN is a duplicate: {}".format(new_row["UPRN"]))
-                    duplicate_primary_keys.add(new_row[primary_key])
-                    lines_dropped += 1
-                    logger.warning("Lines dropped = {}, do not use resume".format(lines_dropped))
-                    # print("UPRN = {} has already been seen".format(row[0]))
-
-            # Print an interim report
-            if (line_count % report_size) == 0 and line_count != 0:
-                est_completion_time = ((time.time() - t0) / line_count) * (
-                    min(file_length, test_line_limit) - (line_count + line_count_offset)
-                )
-                completion_str = (
-                    datetime.datetime.now() + datetime.timedelta(seconds=est_completion_time)
-                ).strftime("%Y-%m-%d %H:%M:%S")
-                print(
-                    "Wrote {}/{} at ({}). Estimated completion time: {}".format(
-                        line_count + line_count_offset,
-                        file_length,
-                        datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        completion_str,
-                    ),
-                    end="\r",
-                    flush=True,
-                )
-
-            if (line_count % log_report_size) == 0 and line_count != 0:
-                est_completion_time = ((time.time() - t0) / line_count) * (
-                    min(file_length, test_line_limit) - (line_count + line_count_offset)
-                )
-                completion_str = (
-                    datetime.datetime.now() + datetime.timedelta(seconds=est_completion_time)
-                ).strftime("%Y-%m-%d %H:%M:%S")
-                logging.info(
-                    "Wrote {}/{} at ({}). Estimated completion time: {}".format(
-                        line_count + line_count_offset,
-                        file_length,
-                        datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        completion_str,
+                    new_rows = rowmaker(
+                        row,
+                        data_path,
+                        data_field_lookup,
+                        revised_db_fields[table],
+                        null_equivalents,
+                        autoinc,
+                        primary_key,
                     )
-                )
 
-            # Write a chunk to the database
-            if (line_count % chunk_size) == 0:
-                if len(data) != 0:
-                    try:
-                        write_to_db(data, db_config, revised_db_fields[table], table=table)
-                    except:  # noqa: E722 do not use bare 'except'
+                # Drop a line if it is malformed
+                if new_rows is None:
+                    logger.debug(
+                        "Dropped input line = {} because a valid row could not be made "
+                        "from it".format(row)
+                    )
+                    malformed_lines += 1
+                    continue
+
+                if not isinstance(new_rows, list):
+                    new_rows = [new_rows]
+
+                # Drop row if it has a duplicate primary key
+
+                for new_row in new_rows:
+                    if (
+                        autoinc
+                        or (primary_key is None)
+                        or (new_row[primary_key_lookup] not in primary_key_set)
+                    ):
+                        # data.append(([x for x in new_row.values()]))
+                        data.append(new_row)
+                        if primary_key is not None:
+                            primary_key_set.add(new_row[primary_key_lookup])
+                    else:
+                        # print("UPRN is a duplicate: {}".format(new_row["UPRN"]))
+                        duplicate_primary_keys.add(new_row[primary_key_lookup])
+                        lines_dropped += 1
                         logger.warning(
-                            "A bad thing happened on attempting to upload chunk to db, "
-                            "doing it line by line to find problem"
+                            "Lines dropped = {}, do not use resume".format(lines_dropped)
                         )
-                        logger.warning("If this succeeds likely problem is oversized chunk of data")
-                        for i, d in enumerate(data):
-                            logger.info("{}. About to upload {}".format(i, d))
-                            write_to_db([d], db_config, revised_db_fields[table], table=table)
-
-                chunk_count += 1
-                # Update chunk_count to db metadata
-                metadata = [OrderedDict([("chunk_count", chunk_count), ("SequenceNumber", id_)])]
-                update_to_db(
-                    metadata,
-                    db_config,
-                    ["chunk_count", "SequenceNumber"],
-                    table="metadata",
-                    key="SequenceNumber",
+                        # print("UPRN = {} has already been seen".format(row[0]))
+
+                # Print an interim report
+                if (line_count % report_size) == 0 and line_count != 0:
+                    est_completion_time = ((time.time() - t0) / line_count) * (
+                        min(file_length, test_line_limit) - (line_count + line_count_offset)
+                    )
+                    completion_str = (
+                        datetime.datetime.now() + datetime.timedelta(seconds=est_completion_time)
+                    ).strftime("%Y-%m-%d %H:%M:%S")
+                    print(
+                        "Wrote {}/{} at ({}). Estimated completion time: {}".format(
+                            line_count + line_count_offset,
+                            file_length,
+                            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            completion_str,
+                        ),
+                        end="\r",
+                        flush=True,
+                    )
+
+                if (line_count % log_report_size) == 0 and line_count != 0:
+                    est_completion_time = ((time.time() - t0) / line_count) * (
+                        min(file_length, test_line_limit) - (line_count + line_count_offset)
+                    )
+                    completion_str = (
+                        datetime.datetime.now() + datetime.timedelta(seconds=est_completion_time)
+                    ).strftime("%Y-%m-%d %H:%M:%S")
+                    logging.info(
+                        "Wrote {}/{} at ({}). Estimated completion time: {}".format(
+                            line_count + line_count_offset,
+                            file_length,
+                            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            completion_str,
+                        )
+                    )
+
+                # Write a chunk to the database
+                if (line_count % chunk_size) == 0:
+                    if len(data) != 0:
+                        try:
+                            write_to_db(data, db_config, revised_db_fields[table], table=table)
+                        except:  # noqa: E722 do not use bare 'except'
+                            logger.warning(
+                                "A bad thing happened on attempting to upload chunk to db, "
+                                "doing it line by line to find problem"
+                            )
+                            logger.warning(
+                                "If this succeeds likely problem is oversized chunk of data"
+                            )
+                            for i, d in enumerate(data):
+                                logger.info("{}. About to upload {}".format(i, d))
+                                write_to_db([d], db_config, revised_db_fields[table], table=table)
+
+                    chunk_count += 1
+                    # Update chunk_count to db metadata
+                    metadata = [{"chunk_count": chunk_count, "SequenceNumber": id_}]
+                    update_to_db(
+                        metadata,
+                        db_config,
+                        ["chunk_count", "SequenceNumber"],
+                        table="metadata",
+                        key="SequenceNumber",
+                    )
+                    # Update current time and chunk count to session log
+                    time_ = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    session_log = [{"last_chunk": chunk_count, "end_time": time_, "ID": sessid}]
+
+                    update_to_db(
+                        session_log,
+                        db_config,
+                        ["last_chunk", "end_time", "ID"],
+                        table="session_log",
+                        key="ID",
+                    )
+                    data = []
+
+                # Break if we have reached test_line_limit
+                if i > test_line_limit:
+                    break
+        except Exception as ex:
+            logger.critical("Encountered exception '{}' at line_count = {}".format(ex, line_count))
+            # print("Row: {}".format(row))
+            # for key in row.keys():
+            #    print("Key: '{:30}', value: '{:}'".format(key, row[key]))
+            # raise
+            # print("Carrying on regardless", flush=True)
+            raise
+
+        # Final write to database
+        logging.info("Final write to database of {} lines".format(len(data)))
+        write_to_db(data, db_config, revised_db_fields[table], whatever=True, table=table)
+
+        # Write a final report
+        t1 = time.time()
+        elapsed = t1 - t0
+        logger.info(
+            "Wrote a total {} lines to the database in {:.2f}s".format(
+                line_count + line_count_offset, elapsed
+            )
+        )
+        if lines_dropped > 0:
+            logger.warning(
+                "Dropped {} lines because they contained duplicate primary key ({})".format(
+                    lines_dropped, primary_key
                 )
-                # Update current time and chunk count to session log
-                time_ = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                session_log = [
-                    OrderedDict([("last_chunk", chunk_count), ("end_time", time_), ("ID", sessid)])
-                ]
-
-                update_to_db(
-                    session_log,
-                    db_config,
-                    ["last_chunk", "end_time", "ID"],
-                    table="session_log",
-                    key="ID",
+            )
+
+        if malformed_lines > 0:
+            logger.warning("Dropped {} lines because they were malformed".format(malformed_lines))
+
+        finish_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        # Now we are autoincrementing the SequenceNumber field,
+        # we need to do a read_db to find the value
+        actual_id = get_current_sequencenumber(db_config)
+
+        # Make a final write to the metadata table
+        metadata = [
+            (actual_id, data_path, datafile_sha, "Complete", start_time, finish_time, finish_time)
+        ]
+        update_fields = [x for x in revised_db_fields["metadata"].keys()]
+        metadata = [
+            {
+                "SequenceNumber": actual_id,
+                "data_path": data_path,
+                "datafile_sha": datafile_sha,
+                "status": "Complete",
+                "start_time": start_time,
+                "finish_time": finish_time,
+                "last_write_time": finish_time,
+                "chunk_count": chunk_count,
+            }
+        ]
+
+        update_to_db(metadata, db_config, update_fields, table="metadata", key="SequenceNumber")
+
+        return db_config, "Completed"
+    finally:
+        if not keep_connection:
+            close_db(db_config)
+
+
+def do_etl_many(
+    db_fields,
+    db_config,
+    data_paths,
+    data_field_lookup,
+    max_workers=None,
+    force=False,
+    headers=True,
+    separator=",",
+    encoding="utf-8-sig",
+    rowsource=get_source_generator,
+    **kwargs,
+):
+    """This function uploads a list of CSV files to a database, parsing them in worker processes
+
+    Files are parsed in parallel, at most max_workers at a time, whilst the main process writes
+    each one to the database in turn with do_etl so metadata and session logs are the same as
+    for sequential calls. Parsed rows are passed back through a temporary file, read in chunks
+    as they are written, and files which have already been uploaded are not parsed.
+
+    Args:
+       db_fields, db_config, data_field_lookup:
+            As for do_etl
+       data_paths (list of str):
+            File paths to the input CSV data, loaded in the order supplied
+
+    Keyword args:
+       max_workers (int):
+            The number of parsing processes, defaults to the number of CPUs
+       force (bool):
+            if True then the database is dropped before the first file is loaded
+       rowsource (function):
+            As for do_etl, it must be importable at module level so it can be sent to a worker
+       **kwargs:
+            Further keyword arguments are passed to do_etl
+
+    Return:
+       db_config (dict):
+            a db_config structure as returned by the final do_etl
+       statuses (list of str):
+            the do_etl status for each file in data_paths
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    db_config = _normalise_config(db_config)
+    sha_algorithm = kwargs.get("sha_algorithm", "sha1")
+
+    statuses = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+        def submit(data_path):
+            # Files already loaded are not parsed, unless force is about to drop the database
+            if not force:
+                datafile_sha = calculate_file_sha(
+                    data_path, encoding=encoding, algorithm=sha_algorithm
                 )
-                data = []
-
-            # Break if we have reached test_line_limit
-            if i > test_line_limit:
-                break
-    except Exception as ex:
-        logger.critical("Encountered exception '{}' at line_count = {}".format(ex, line_count))
-        # print("Row: {}".format(row))
-        # for key in row.keys():
-        #    print("Key: '{:30}', value: '{:}'".format(key, row[key]))
-        # raise
-        # print("Carrying on regardless", flush=True)
-        raise
-
-    # Final write to database
-    logging.info("Final write to database of {} lines".format(len(data)))
-    write_to_db(data, db_config, revised_db_fields[table], whatever=True, table=table)
-
-    # Write a final report
-    t1 = time.time()
-    elapsed = t1 - t0
-    logger.info(
-        "Wrote a total {} lines to the database in {:.2f}s".format(
-            line_count + line_count_offset, elapsed
+                if datafile_sha is None:
+                    datafile_sha = rowsource.__name__
+                if check_if_already_done(data_path, db_config, datafile_sha):
+                    return data_path, None
+            return data_path, executor.submit(
+                _read_rows, rowsource, data_path, headers, separator, encoding
+            )
+
+        paths = iter(data_paths)
+        pending = deque(submit(x) for x in islice(paths, max_workers))
+        try:
+            while pending:
+                data_path, future = pending.popleft()
+                for next_path in islice(paths, 1):
+                    pending.append(submit(next_path))
+                if future is None:
+                    logger.info("Data file {} has already been uploaded".format(data_path))
+                    statuses.append("Already done")
+                    continue
+                rows_path = future.result()
+                try:
+                    db_config, status = do_etl(
+                        db_fields,
+                        db_config,
+                        data_path,
+                        data_field_lookup,
+                        force=force,
+                        headers=headers,
+                        separator=separator,
+                        encoding=encoding,
+                        rowsource=_preparsed_source(rows_path, rowsource.__name__),
+                        **kwargs,
+                    )
+                finally:
+                    os.remove(rows_path)
+                force = False
+                statuses.append(status)
+        finally:
+            # Parsed files which will not now be loaded are removed once their workers finish
+            for _, future in pending:
+                if future is not None and not future.cancel():
+                    # An error here would hide the one which stopped the loop
+                    try:
+                        os.remove(future.result())
+                    except Exception:
+                        pass
+
+    return db_config, statuses
+
+
+def _read_rows(rowsource, data_path, headers, separator, encoding):
+    """This function parses a file in a worker process, pickling the rows to a temporary file in
+    chunks so that neither process holds the whole file in memory
+
+    Returns:
+       the path of the temporary file, which the caller removes
+    """
+    rows = rowsource(data_path, headers, separator, encoding)
+    with tempfile.NamedTemporaryFile("wb", suffix=".pickle", delete=False) as fh:
+        try:
+            while True:
+                chunk = list(islice(rows, PARSED_CHUNK_SIZE))
+                if len(chunk) == 0:
+                    break
+                pickle.dump(chunk, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        except BaseException:
+            fh.close()
+            os.remove(fh.name)
+            raise
+
+    return fh.name
+
+
+def _preparsed_source(rows_path, name):
+    def rowsource(data_path, headers, separator, encoding):
+        with open(rows_path, "rb") as fh:
+            while True:
+                try:
+                    chunk = pickle.load(fh)
+                except EOFError:
+                    return
+                yield from chunk
+
+    rowsource.__name__ = name
+    return rowsource
+
+
+def _fast_load_csv(
+    conn,
+    csv_extension,
+    table,
+    db_fields,
+    data_field_lookup,
+    null_equivalents,
+    autoinc,
+    primary_key,
+    data_path,
+):
+    """This function loads a CSV file using sqlite's csv virtual table, from the loadable
+    extension at the path csv_extension
+
+    Returns:
+       (line_count, lines_dropped), or None if the file can't be loaded this way
+    """
+    stage_select = _make_stage_select(
+        db_fields, data_field_lookup, null_equivalents, autoinc, primary_key
+    )
+    if stage_select is None:
+        return None
+
+    # The csv extension doesn't skip a byte order mark, so it would end up in the first header
+    with open(data_path, "rb") as fh:
+        if fh.read(3) == b"\xef\xbb\xbf":
+            return None
+
+    try:
+        conn.enable_load_extension(True)
+        conn.load_extension(csv_extension)
+        conn.enable_load_extension(False)
+    except (AttributeError, sqlite3.OperationalError) as ex:
+        logger.info("sqlite csv extension not available ({}), loading row by row".format(ex))
+        return None
+
+    conn.execute(
+        "CREATE VIRTUAL TABLE temp.etl_stage USING csv(filename='{}', header=YES)".format(
+            data_path.replace("'", "''")
         )
     )
-    if lines_dropped > 0:
-        logger.warning(
-            "Dropped {} lines because they contained duplicate primary key ({})".format(
-                lines_dropped, primary_key
+    try:
+        fast_load = _load_from_stage(conn, table, stage_select, data_field_lookup, primary_key)
+    finally:
+        conn.execute("DROP TABLE temp.etl_stage")
+    if fast_load is not None:
+        conn.commit()
+
+    return fast_load
+
+
+def _make_stage_select(db_fields, data_field_lookup, null_equivalents, autoinc, primary_key):
+    """This function builds the fields, SELECT expressions and parameters used to copy
+    temp.etl_stage to the output table, or returns None if a field needs converting in Python
+    """
+    insert_fields = []
+    select_fields = []
+    parameters = []
+    null_placeholders = ",".join("?" * len(null_equivalents))
+    for output_key, field_type in db_fields.items():
+        lookup = data_field_lookup[output_key]
+        if autoinc and output_key == primary_key:
+            continue
+        insert_fields.append(output_key)
+        if lookup is None or isinstance(lookup, list):
+            select_fields.append("NULL")
+        elif field_type == "POINT" or field_type.lower() == "integer":
+            return None
+        elif len(null_equivalents) == 0:
+            select_fields.append('"{}"'.format(lookup))
+        else:
+            select_fields.append(
+                'CASE WHEN "{0}" IN ({1}) THEN NULL ELSE "{0}" END'.format(
+                    lookup, null_placeholders
+                )
             )
-        )
+            parameters.extend(null_equivalents)
 
-    if malformed_lines > 0:
-        logger.warning("Dropped {} lines because they were malformed".format(malformed_lines))
-
-    finish_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    # Now we are autoincrementing the SequenceNumber field,
-    # we need to do a read_db to find the value
-    actual_id = get_current_sequencenumber(db_config)
-
-    # Make a final write to the metadata table
-    metadata = [
-        (actual_id, data_path, datafile_sha, "Complete", start_time, finish_time, finish_time)
-    ]
-    update_fields = [x for x in revised_db_fields["metadata"].keys()]
-    metadata = [
-        OrderedDict(
-            [
-                ("SequenceNumber", actual_id),
-                ("data_path", data_path),
-                ("datafile_sha", datafile_sha),
-                ("status", "Complete"),
-                ("start_time", start_time),
-                ("finish_time", finish_time),
-                ("last_write_time", finish_time),
-                ("chunk_count", chunk_count),
-            ]
-        )
-    ]
+    return insert_fields, select_fields, parameters
+
+
+def _load_from_stage(conn, table, stage_select, data_field_lookup, primary_key):
+    """This function copies temp.etl_stage into the output table with a single INSERT ... SELECT
 
-    update_to_db(metadata, db_config, update_fields, table="metadata", key="SequenceNumber")
+    Returns:
+       (line_count, lines_dropped), or None if the staged rows repeat a primary key or one
+       already in the table, since the row by row route handles those itself
+    """
+    insert_fields, select_fields, parameters = stage_select
+    key_lookup = data_field_lookup.get(primary_key) if primary_key is not None else None
+
+    if isinstance(key_lookup, str):
+        line_count, distinct_keys = conn.execute(
+            'SELECT count(*), count(DISTINCT "{}") FROM temp.etl_stage'.format(key_lookup)
+        ).fetchone()
+        if distinct_keys != line_count:
+            logger.info("Input file repeats primary keys, loading row by row")
+            return None
+        # The row by row route raises or drops keys already in the table depending on which
+        # chunk they fall in, so those files are left to it for the same result
+        already_loaded = conn.execute(
+            'SELECT EXISTS (SELECT 1 FROM {0} JOIN temp.etl_stage ON {0}."{1}" = '
+            'temp.etl_stage."{2}")'.format(table, primary_key, key_lookup)
+        ).fetchone()[0]
+        if already_loaded:
+            logger.info(
+                "Input file repeats primary keys already in {}, loading row by row".format(table)
+            )
+            return None
+    else:
+        line_count = conn.execute("SELECT count(*) FROM temp.etl_stage").fetchone()[0]
+
+    # No staged key is repeated or already in the table, so a plain INSERT writes every row
+    conn.execute(
+        "INSERT INTO {} ({}) SELECT {} FROM temp.etl_stage".format(
+            table, ",".join(insert_fields), ",".join(select_fields)
+        ),
+        parameters,
+    )
 
-    return db_config, "Completed"
+    return line_count, 0
 
 
 def get_current_sequencenumber(db_config):
     # Get metadata id_ back out of the database
     sql_query = "select max(SequenceNumber) as SequenceNumber from metadata;"
 
-    results = list(read_db(sql_query, db_config))
-    if len(results) != 0:
-        actual_id = results[0]["SequenceNumber"]
-    else:
-        actual_id = None
+    actual_id = read_db_scalar(sql_query, db_config)
 
     return actual_id
 
@@ -649,24 +1125,27 @@ def check_if_already_done(data_path, db_config, datafile_sha):
     status = False
     # Check for the existance of the database, return False if they don't exist
     if db_config["db_type"] == "sqlite":
-        if not os.path.isfile(db_config["db_path"]):
+        if db_config["db_path"] == MEMORY_DB_PATH:
+            if not check_table_exists(db_config, "metadata"):
+                return False
+        elif not os.path.isfile(db_config["db_path"]):
             return False
     elif db_config["db_type"] == "mysql" or db_config["db_type"] == "mariadb":
         if not check_mysql_database_exists(db_config):
             return False
 
-    # Look for the datafile_sha in the metadata table and if it exists, return True
-    sql_query = "select * from metadata where datafile_sha = '{}' and status = 'Complete'".format(
-        datafile_sha
+    # Look for the datafile_sha in the metadata table and if it exists, return True. We only need
+    # the count so the database does not have to hand back the rows
+    sql_query = (
+        "select count(*) as n from metadata "
+        "where datafile_sha = '{}' and status = 'Complete'".format(datafile_sha)
     )
 
-    results = list(read_db(sql_query, db_config))
+    completed_count = read_db_scalar(sql_query, db_config)
 
     logging.debug("Checking for completeness of {} with {}".format(db_config, sql_query))
 
-    # print(results, flush=True)
-
-    if len(results) == 1:
+    if completed_count == 1:
         return True
     else:
         return False
@@ -675,15 +1154,35 @@ def check_if_already_done(data_path, db_config, datafile_sha):
 
 
 def make_point(row, data_field_lookup):
+    return _format_point(row[data_field_lookup[0]], row[data_field_lookup[1]])
+
+
+def make_points(rows, data_field_lookup):
+    """This function makes the POINT strings for a batch of rows, as make_point does for one
+
+    Args:
+       rows (list):
+            input rows, dictionaries or lists
+       data_field_lookup (list):
+            the keys or indices of the easting and northing in each row
+
+    Returns:
+       A list of POINT strings in the same order as rows
+    """
+    get_coordinates = operator.itemgetter(data_field_lookup[0], data_field_lookup[1])
+    return [_format_point(*coordinates) for coordinates in map(get_coordinates, rows)]
+
+
+def _format_point(easting, northing):
     try:
-        easting = float(row[data_field_lookup[0]])
+        easting = float(easting)
     except ValueError:
         easting = 0
     try:
-        northing = float(row[data_field_lookup[1]])
+        northing = float(northing)
     except ValueError:
         northing = 0
-    point = "POINT({} {})".format(easting, northing)
+    point = _POINT_FORMAT(easting, northing)
     return point
 
 
@@ -702,14 +1201,62 @@ def get_primary_key_from_db_fields(db_fields):
 def report_input_length(rowsource, test_line_limit, data_path, headers, separator, encoding):
     t0 = time.time()
 
-    file_length = (
-        sum(1 for row in rowsource(data_path, headers, separator, encoding)) - 1
-    )  # Take off the header line
+    # For local files and zip members read by the default rowsource we can count newlines in
+    # binary rather than parsing every row. This treats quoted fields containing newlines as
+    # separate lines. With headers, blank lines are left out since the rows as dicts skip them
+    line_count = None
+    zip_path, _ = split_zipfile_path(data_path)
+    # Files are opened in the locale's encoding when none is given
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+    if (
+        rowsource is get_source_generator
+        and os.path.isfile(zip_path)
+        and "\n\n".encode(encoding).endswith(b"\n\n")
+    ):
+        line_count = _count_lines(data_path, skip_blank_lines=headers)
+
+    if line_count is not None:
+        file_length = line_count - 1
+        if headers and line_count > 0:
+            file_length -= 1
+    else:
+        file_length = (
+            sum(1 for row in rowsource(data_path, headers, separator, encoding)) - 1
+        )  # Take off the header line
     logger.info("{} lines available, limit set to {}".format(file_length, test_line_limit))
     logger.info("{:.2f}s taken to count lines\n".format(time.time() - t0))
     return file_length
 
 
+def _count_lines(file_path, skip_blank_lines=False):
+    fh = get_a_file_handle(file_path, encoding=None, mode="rb")
+    if fh is None:
+        return None
+
+    line_count = 0
+    last_chunk = b""
+    # The start of the file counts as following a newline, so a blank first line is found. The
+    # end of the previous chunk is carried over for blank lines which straddle two chunks
+    tail = b"\n"
+    with fh:
+        for chunk in iter(lambda: fh.read(SOURCE_BUFFER_SIZE), b""):
+            line_count += chunk.count(b"\n")
+            if skip_blank_lines:
+                text = tail + chunk
+                for match in BLANK_LINE.finditer(text):
+                    if match.end() > len(tail):
+                        line_count -= 1
+                tail = text[-2:]
+            last_chunk = chunk
+
+    # A final line without a trailing newline still counts
+    if last_chunk and not last_chunk.endswith(b"\n"):
+        line_count += 1
+
+    return line_count
+
+
 def make_dbfields(file_path):
     fh = get_a_file_handle(file_path)
 
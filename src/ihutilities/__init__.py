@@ -5,11 +5,15 @@ This module contains utility functions relating to databases, git and I/O
 """
 from .db_utils import (
     configure_db,
+    open_db,
+    close_db,
     write_to_db,
     update_to_db,
     drop_db_tables,
     read_db,
+    read_db_scalar,
     finalise_db,
+    indexes_disabled,
     delete_from_db,
     db_config_template,
     check_mysql_database_exists,
@@ -20,6 +24,7 @@ from .git_utils import git_uncommitted_changes, git_sha, git_calculate_file_sha,
 from .io_utils import (
     write_dictionary,
     calculate_file_sha,
+    calculate_file_shas,
     get_a_file_handle,
     split_zipfile_path,
     download_file_from_url,
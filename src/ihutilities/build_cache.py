@@ -6,15 +6,23 @@
 # Ideal for building databases which require a long time to make
 
 import functools
+import itertools
 import os
+import queue
 import datetime
 import sqlite3
+import sys
+import threading
 import time
 import logging
+import math
+import operator
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
-from ihutilities import configure_db, write_to_db, update_to_db, read_db
+from ihutilities import configure_db, write_to_db, update_to_db, read_db_scalar, open_db, close_db
+from ihutilities.ETL_framework import get_primary_key_from_db_fields
 
 metadata_fields = OrderedDict(
     [
@@ -43,12 +51,60 @@ session_log_fields = OrderedDict(
 
 user_fields = OrderedDict([("key", "TEXT PRIMARY KEY"), ("value", "TEXT")])
 
+# WAL journal_mode persists in the database file, the rest apply to the connection they are run on
+cache_db_pragmas = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA mmap_size=268435456;",
+    "PRAGMA cache_size=-131072;",
+]
+
 logger = logging.getLogger(__name__)
 
 
 def build_cache(
-    constructors, cache_db, cache_fields, sha, chunk_size=1000, report_frequency=10, test=True
+    constructors,
+    cache_db,
+    cache_fields,
+    sha,
+    chunk_size=1000,
+    report_frequency=10,
+    test=True,
+    max_workers=None,
 ):
+    """
+    This function builds a sqlite cache database stage by stage, it can be stopped and restarted
+    and will resume from the last chunk written
+
+    Args:
+       constructors (list of tuples):
+            (key_generator, key_count, make_row_method) per stage. key_generator(chunk_size)
+            yields lists of keys, key_count() returns the number of keys and
+            make_row_method(key) returns a row, or a list of rows. An optional fourth element,
+            make_rows_batch(keys), returns the rows for a whole chunk of keys, such as a numpy
+            array, and is used in place of make_row_method
+       cache_db (str):
+            path to the sqlite cache database
+       cache_fields (OrderedDict):
+            fieldnames and types for the property_data table. Rows in each chunk are sorted on
+            a single PRIMARY KEY field, if there is one, before they are written
+       sha (str):
+            a fingerprint for the code building the cache, recorded in the session_log
+
+    Keyword args:
+       chunk_size (int):
+            the number of keys written per transaction
+       report_frequency (int):
+            approximate number of progress reports logged per stage
+       test (bool):
+            if True the cache is written to test.sqlite alongside cache_db
+       max_workers (int):
+            if set, rows are made in a process pool of this size
+
+    Returns:
+       the path to the cache database
+    """
     if test:
         output_dir = os.path.dirname(cache_db)
         cache_db = os.path.join(output_dir, "test.sqlite")
@@ -74,15 +130,80 @@ def build_cache(
         configure_db(cache_db, db_fields, tables=list(db_fields.keys()))
     else:
         logger.info("Creating database at {}".format(cache_db))
+        create_cache_db(cache_db)
         configure_db(cache_db, db_fields, tables=list(db_fields.keys()))
 
+    # Everything set up here is released in the finally, whichever step raises
+    pool = None
+    writer = None
+    db_config = None
+    try:
+        # With max_workers rows are made in a process pool, the database is only written from here
+        row_mapper = map
+        if max_workers is not None:
+            pool = ProcessPoolExecutor(max_workers=max_workers)
+            row_mapper = functools.partial(
+                pool.map, chunksize=max(1, chunk_size // (max_workers * 4))
+            )
+
+        # Chunks are written on their own thread and connection while the next chunk is made
+        chunk_writer = ChunkWriter(cache_db, db_fields)
+        chunk_writer.start()
+        writer = chunk_writer
+
+        # A single connection is held for the whole build for everything else
+        db_config = open_db(cache_db)
+        set_cache_db_pragmas(db_config["db_conn"])
+
+        total_line_count = run_constructors(
+            constructors,
+            db_config,
+            db_fields,
+            sha,
+            chunk_size,
+            report_frequency,
+            row_mapper,
+            writer,
+        )
+    finally:
+        if writer is not None:
+            writer.stop()
+        if db_config is not None:
+            close_db(db_config)
+        if pool is not None:
+            pool.shutdown()
+
+    # Write final report
+    t1 = time.time()
+    elapsed = t1 - t0
+    logger.info(
+        "\nWrote a total {0} records to {1} in {2:.2f}s".format(
+            total_line_count, os.path.basename(cache_db), elapsed
+        )
+    )
+
+    return cache_db
+
+
+def run_constructors(
+    constructors,
+    db_config,
+    db_fields,
+    sha,
+    chunk_size,
+    report_frequency,
+    row_mapper=map,
+    writer=None,
+):
+    update_fields = list(db_fields["metadata"])
     # Loop over the constructors
     total_line_count = 0
-    for id_, (key_generator, key_count, make_row_method) in enumerate(constructors):
+    for id_, (key_generator, key_count, make_row_method, *batch) in enumerate(constructors):
+        make_rows_batch = batch[0] if batch else None
         key_generator_name = get_function_name(key_generator)
         make_row_method_name = get_function_name(make_row_method)
 
-        stage_status = check_stage_status(key_generator, make_row_method, cache_db)
+        stage_status = check_stage_status(key_generator, make_row_method, db_config["db_conn"])
         if stage_status == "Complete":
             logger.info(
                 "Flatfile db already updated with {}, continuing to next stage".format(
@@ -105,7 +226,7 @@ def build_cache(
                 )
             ]
             logger.info("Trying to add metadata line: {}".format(metadata))
-            write_to_db(metadata, cache_db, db_fields["metadata"], table="metadata")
+            write_to_db(metadata, db_config, db_fields["metadata"], table="metadata")
 
         t_update0 = time.time()
         logger.info("\nUpdating flatfile db with {}".format(make_row_method_name))
@@ -115,11 +236,14 @@ def build_cache(
             key_generator,
             key_count,
             make_row_method,
-            cache_db,
+            db_config,
             db_fields,
             sha,
             chunk_size,
             report_frequency,
+            row_mapper,
+            writer,
+            make_rows_batch,
         )
         #
         total_line_count += line_count
@@ -129,7 +253,7 @@ def build_cache(
         finish_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         logger.info(
             "Wrote {0} '{1}' records to {2} in {3:.2f}s".format(
-                line_count, make_row_method_name, os.path.basename(cache_db), elapsed
+                line_count, make_row_method_name, os.path.basename(db_config["db_path"]), elapsed
             )
         )
         metadata = [
@@ -143,20 +267,10 @@ def build_cache(
                 finish_time,
             )
         ]
-        update_fields = [x for x in db_fields["metadata"].keys()]
-        update_to_db(metadata, cache_db, update_fields, table="metadata", key="SequenceNumber")
+        update_to_db(metadata, db_config, update_fields, table="metadata", key="SequenceNumber")
         # update_to_db(metadata, db_file_path, db_fields["metadata"], table="metadata")
 
-    # Write final report
-    t1 = time.time()
-    elapsed = t1 - t0
-    logger.info(
-        "\nWrote a total {0} records to {1} in {2:.2f}s".format(
-            total_line_count, os.path.basename(cache_db), elapsed
-        )
-    )
-
-    return cache_db
+    return total_line_count
 
 
 def updater(
@@ -164,11 +278,14 @@ def updater(
     key_method,
     get_key_count,
     make_row_method,
-    cache_db,
+    db_config,
     db_fields,
     sha,
     chunk_size,
     report_frequency,
+    row_mapper=map,
+    writer=None,
+    make_rows_batch=None,
 ):
     key_method_name = get_function_name(key_method)
     make_row_method_name = get_function_name(make_row_method)
@@ -185,33 +302,32 @@ def updater(
     line_count_offset = 0
     logger.info("Test_limit set to {}".format(test_limit))
 
+    # Rows are written in primary key order so inserts append to the B-tree rather than split it
+    primary_key = get_primary_key_from_db_fields(db_fields["property_data"])
+    sort_key = None
+    if primary_key is not None:
+        sort_key = operator.itemgetter(list(db_fields["property_data"]).index(primary_key))
+
     # Fetch chunk progress
-    chunk_skip = get_chunk_count(id_, cache_db)
+    chunk_skip = get_chunk_count(id_, db_config["db_conn"])
     logger.info("Skipping {} chunks".format(chunk_skip))
     # ** Skip chunks
-    n_key_chunks = len(list(key_method(chunk_size)))
+    n_key_chunks = math.ceil(key_count / chunk_size)
     key_chunks = key_method(chunk_size)
 
     if chunk_skip != 0:
-        for i in range(0, chunk_skip):
-            print(
-                "Skipping chunk {} in ({}, {})".format(i, key_method_name, make_row_method_name),
-                flush=True,
-                end="\r",
-            )
-            key_chunks.__next__()
-            line_count_offset = chunk_size * chunk_skip
-            chunk_count = chunk_skip
+        # Consume the skipped chunks without handling each one in Python
+        deque(itertools.islice(key_chunks, chunk_skip), maxlen=0)
+        line_count_offset = chunk_size * chunk_skip
+        chunk_count = chunk_skip
 
     # Update session log here
     time_ = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     session_log_data = [(None, make_row_method_name, time_, time_, sha, chunk_skip, chunk_skip)]
-    write_to_db(session_log_data, cache_db, db_fields["session_log"], table="session_log")
+    write_to_db(session_log_data, db_config, db_fields["session_log"], table="session_log")
 
-    # Pick up session log data
-    sql_query = "select * from session_log order by ID desc;"
-    results = list(read_db(sql_query, cache_db))
-    sessid = results[0]["ID"]
+    # Pick up session log ID, the connection is held open so this is the row we just wrote
+    sessid = read_db_scalar("SELECT last_insert_rowid();", db_config)
 
     t0 = time.time()
 
@@ -219,6 +335,10 @@ def updater(
     if log_report_size == 0:
         log_report_size = 1
 
+    # The progress line is only useful on a terminal, and only needs redrawing now and again
+    show_progress = sys.stdout.isatty()
+    progress_report_size = max(1, log_report_size // 10)
+
     logger.info("Chunk size {}, writing to log every {} chunks".format(chunk_size, log_report_size))
     for i, keys in enumerate(key_chunks, start=1):
         # for uprns in uprn_source(uprn_method, chunk_size):
@@ -229,80 +349,58 @@ def updater(
 
         # if len(uprns) == 0:
         #    break
-        data = []
-
-        for key in keys:
-            if key in ["", None]:
-                logger.info("key is blank so continuing")
-                continue
-
-            # This is what makes a cache row
-            # time.sleep(4/1000)
-            data_row = make_row_method(key)
-
-            # Location Intelligence returns a list at this point
-            # Location Intelligence LIDAR will return a list of lists
-            #
-            if len(data_row) == 0:
-                continue
-
-            if isinstance(data_row[0], list):
-                data.extend(data_row)
-                line_count += len(data_row)
-            else:
-                data.append(data_row)
-                line_count += 1
-
-        # Insert record batch
-        if len(data) != 0:
+
+        # This is what makes a cache row
+        # time.sleep(4/1000)
+        if make_rows_batch is None:
+            data = list(flatten_rows(row_mapper(make_row_method, non_blank_keys(keys))))
+        else:
+            # A batch method makes the whole chunk at once, it may return a numpy array
+            rows = make_rows_batch(list(non_blank_keys(keys)))
+            data = rows.tolist() if hasattr(rows, "tolist") else list(rows)
+        line_count += len(data)
+        if sort_key is not None:
             try:
-                write_to_db(data, cache_db, db_fields["property_data"])
-            except sqlite3.OperationalError:
-                logger.info("Caught exception write_to_db, trying again once after 10 seconds")
-                time.sleep(5)
-                write_to_db(data, cache_db, db_fields["property_data"])
-
-        # Update chunk_count to db metadata
-        update_to_db(
-            [(chunk_count, id_)],
-            cache_db,
-            ["chunk_count", "SequenceNumber"],
-            table="metadata",
-            key="SequenceNumber",
-        )
-        # Update current time and chunk count to session log
-        time_ = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        update_to_db(
-            [(chunk_count, time_, sessid)],
-            cache_db,
-            ["last_chunk", "end_time", "ID"],
-            table="session_log",
-            key="ID",
-        )
+                data.sort(key=sort_key)
+            except TypeError:
+                # Keys which do not compare, such as None for an autoincrement, are left as is
+                pass
+
+        # Insert record batch along with the chunk_count and session log updates
+        now = time.time()
+        now_struct = time.localtime(now)
+        time_ = time.strftime("%Y-%m-%d %H:%M:%S", now_struct)
+        if writer is None:
+            write_chunk_with_retry(data, chunk_count, time_, id_, sessid, db_config, db_fields)
+        else:
+            writer.put((data, chunk_count, time_, id_, sessid))
 
         if line_count != 0:
-            est_completion_time = ((time.time() - t0) / line_count) * (
+            est_completion_time = ((now - t0) / line_count) * (
                 key_count - (line_count + line_count_offset)
             )
         else:
-            est_completion_time = ((time.time() - t0) / 1) * (key_count - (1 + line_count_offset))
-
-        total_runtime = ((time.time() - t0) + est_completion_time) / (60 * 60 * 24)
-        completion_str = (
-            datetime.datetime.now() + datetime.timedelta(seconds=est_completion_time)
-        ).strftime("%Y-%m-%d %H:%M:%S")
-        print(
-            "{}: {}/{} at {}. Est. completion time: {}. Est. total runtime = {:.2f} days".format(
-                make_row_method_name,
-                line_count + line_count_offset,
-                key_count,
-                datetime.datetime.now().strftime("%H:%M:%S"),
-                completion_str,
-                total_runtime,
-            ),
-            end="\r",
-            flush=True,
+            est_completion_time = ((now - t0) / 1) * (key_count - (1 + line_count_offset))
+
+        total_runtime = ((now - t0) + est_completion_time) / (60 * 60 * 24)
+        completion_str = time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(now + est_completion_time)
         )
+        clock_str = time.strftime("%H:%M:%S", now_struct)
+        if show_progress and (i % progress_report_size) == 0:
+            print(
+                "{}: {}/{} at {}. Est. completion time: {}. "
+                "Est. total runtime = {:.2f} days".format(
+                    make_row_method_name,
+                    line_count + line_count_offset,
+                    key_count,
+                    clock_str,
+                    completion_str,
+                    total_runtime,
+                ),
+                end="\r",
+                flush=True,
+            )
 
         if (i % log_report_size) == 0 and i != 0:
             logger.info(
@@ -311,7 +409,7 @@ def updater(
                     make_row_method_name,
                     line_count + line_count_offset,
                     key_count,
-                    datetime.datetime.now().strftime("%H:%M:%S"),
+                    clock_str,
                     completion_str,
                     total_runtime,
                 )
@@ -319,14 +417,171 @@ def updater(
 
         # time.sleep(5)
 
+    # The stage is only complete once all of its chunks are written
+    if writer is not None:
+        writer.flush()
+
     # close uprn source
     # uprn_cursor.close()
 
     return line_count + line_count_offset
 
 
-def get_chunk_count(id_, cache_db):
+def non_blank_keys(keys):
+    for key in keys:
+        if key in ["", None]:
+            logger.info("key is blank so continuing")
+            continue
+        yield key
+
+
+def flatten_rows(data_rows):
+    for data_row in data_rows:
+        # Location Intelligence returns a list at this point
+        # Location Intelligence LIDAR will return a list of lists
+        #
+        if len(data_row) == 0:
+            continue
+
+        if isinstance(data_row[0], list):
+            yield from data_row
+        else:
+            yield data_row
+
+
+class ChunkWriter(threading.Thread):
+    """
+    A thread which writes chunks to the cache database from a bounded queue, so that making
+    the rows for one chunk overlaps with writing the previous one. Errors are raised in the
+    calling thread on the next put or flush.
+    """
+
+    def __init__(self, cache_db, db_fields, maxsize=4):
+        super().__init__(daemon=True)
+        self.cache_db = cache_db
+        self.db_fields = db_fields
+        self.chunk_queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+
+    def run(self):
+        db_config = None
+        try:
+            db_config = open_db(self.cache_db)
+            set_cache_db_pragmas(db_config["db_conn"])
+        except Exception as err:
+            self.error = err
+
+        # After an error chunks are still taken from the queue, so that put never blocks
+        while True:
+            chunk = self.chunk_queue.get()
+            try:
+                if chunk is None:
+                    break
+                if self.error is None:
+                    write_chunk_with_retry(*chunk, db_config, self.db_fields)
+            except Exception as err:
+                db_config["db_conn"].rollback()
+                self.error = err
+            finally:
+                self.chunk_queue.task_done()
+
+        if db_config is not None:
+            close_db(db_config)
+
+    def put(self, chunk):
+        self._raise_error()
+        self.chunk_queue.put(chunk)
+
+    def flush(self):
+        self.chunk_queue.join()
+        self._raise_error()
+
+    def stop(self):
+        self.chunk_queue.put(None)
+        self.join()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+
+def write_chunk_with_retry(data, chunk_count, time_, id_, sessid, db_config, db_fields):
+    try:
+        write_chunk(data, chunk_count, time_, id_, sessid, db_config, db_fields)
+    except sqlite3.OperationalError:
+        logger.info("Caught exception write_chunk, trying again once after 5 seconds")
+        db_config["db_conn"].rollback()
+        time.sleep(5)
+        write_chunk(data, chunk_count, time_, id_, sessid, db_config, db_fields)
+
+
+def write_chunk(data, chunk_count, time_, id_, sessid, db_config, db_fields):
+    # The data and the progress markers are committed together, so a resumed run can never skip
+    # a chunk which was not written
+    if len(data) != 0:
+        bulk_insert(db_config["db_conn"], "property_data", list(db_fields["property_data"]), data)
+
+    # Update chunk_count to db metadata, and current time and chunk count to session log
+    conn = db_config["db_conn"]
+    conn.execute(
+        "UPDATE metadata SET chunk_count = ? WHERE SequenceNumber = ?;", (chunk_count, id_)
+    )
+    conn.execute(
+        "UPDATE session_log SET last_chunk = ?, end_time = ? WHERE ID = ?;",
+        (chunk_count, time_, sessid),
+    )
+    conn.commit()
+
+
+def bulk_insert(conn, table, columns, rows, max_params=None):
+    # Rows go in as multi-row INSERT ... VALUES (...),(...) statements, keeping under SQLite's
+    # limit on parameters per statement, which is much faster than executemany on one row
+    if max_params is None:
+        max_params = get_max_params(conn)
+    batch_size = max(1, max_params // len(columns))
+    for start in range(0, len(rows), batch_size):
+        end = start + batch_size
+        batch = rows[start:end]
+        insert_statement = _make_bulk_insert_statement(table, tuple(columns), len(batch))
+        conn.execute(insert_statement, list(itertools.chain.from_iterable(batch)))
+
+
+def get_max_params(conn):
+    # The limit was raised from 999 to 32766 in SQLite 3.32, and can be lowered at compile time,
+    # so ask the connection where Python (3.11+) allows it and assume the old limit otherwise
+    try:
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    except AttributeError:
+        return 999
+
+
+@functools.lru_cache(maxsize=32)
+def _make_bulk_insert_statement(table, columns, n_rows):
+    row_placeholder = "({})".format(",".join(["?"] * len(columns)))
+    return "INSERT INTO {} ({}) VALUES {}".format(
+        table, ",".join(columns), ",".join([row_placeholder] * n_rows)
+    )
+
+
+def create_cache_db(cache_db):
+    # page_size only takes effect when a database is created, switching to WAL writes the header
+    # so it sticks. Larger pages make the B-tree shallower for the bulk inserts
+    cache_dir = os.path.dirname(cache_db)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
     conn = sqlite3.connect(cache_db)
+    conn.execute("PRAGMA page_size=8192;")
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.close()
+
+
+def set_cache_db_pragmas(conn):
+    for pragma in cache_db_pragmas:
+        conn.execute(pragma)
+
+
+def get_chunk_count(id_, conn):
     c = conn.cursor()
     c.execute("select chunk_count from metadata where SequenceNumber = ?;", (id_,))
     result = c.fetchall()
@@ -334,11 +589,10 @@ def get_chunk_count(id_, cache_db):
     return chunk_count
 
 
-def check_stage_status(key_method, make_row_method, cache_db):
+def check_stage_status(key_method, make_row_method, conn):
     key_method_name = get_function_name(key_method)
     make_row_method_name = get_function_name(make_row_method)
 
-    conn = sqlite3.connect(cache_db)
     c = conn.cursor()
     c.execute(
         "select status from metadata where key_method = ? and make_row_method = ?;",
@@ -352,6 +606,7 @@ def check_stage_status(key_method, make_row_method, cache_db):
     return stage_complete
 
 
+@functools.lru_cache(maxsize=128)
 def get_function_name(a_function):
     if isinstance(a_function, functools.partial):
         function_name = a_function.func.__name__
@@ -4,14 +4,19 @@
 This package contains functions relating to databases
 """
 
+import contextlib
 import dataclasses
 import datetime
+import functools
 import os
+import queue
 import time
 import sqlite3
 import logging
-from collections import OrderedDict
-from typing import Dict, Union, Iterable, List, Any
+import tempfile
+import operator
+from itertools import groupby, islice, repeat
+from typing import Dict, Union, Iterable, List, Any, Optional
 
 import pymysql
 
@@ -19,6 +24,14 @@ import pymysql
 from pymysql.constants.CR import CR_CONN_HOST_ERROR
 from pymysql.constants.ER import BAD_DB_ERROR
 
+# MariaDB/MySQL are reached with the pure Python pymysql, setting IHUTILITIES_MYSQL_DRIVER to
+# mysqlclient selects its C based MySQLdb driver instead, which is much faster for bulk inserts
+MYSQL_DRIVER = os.environ.get("IHUTILITIES_MYSQL_DRIVER", "pymysql")
+if MYSQL_DRIVER == "mysqlclient":
+    import MySQLdb as _mysql_driver
+    import MySQLdb.cursors  # noqa: F401 makes _mysql_driver.cursors available
+else:
+    _mysql_driver = pymysql
 
 db_config_template = {
     "db_name": "test",
@@ -28,8 +41,45 @@ db_config_template = {
     "db_conn": None,
     "db_type": "mysql",
     "db_path": None,
+    "db_keep_open": False,
+    "db_bulk_load": False,
 }
 
+# A db_config of ":memory:" makes an in-memory sqlite database, which is kept open on the db_config
+# returned by configure_db or do_etl and must be passed on to later calls
+MEMORY_DB_PATH = ":memory:"
+
+# With db_bulk_load set, sqlite connections are tuned for loading, where commit fsyncs dominate.
+# Indexes are best left to finalise_db once the load is complete
+SQLITE_BULK_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-262144;",
+    "PRAGMA mmap_size=268435456;",
+]
+
+# Released MariaDB/MySQL connections are kept here for reuse rather than closed, keyed on
+# (db_host, db_user, db_name, db_bulk_load), which saves a TCP connection and login for every call
+MYSQL_POOL_SIZE = 8
+_mysql_pool = {}
+_mysql_databases_checked = set()
+
+# Field types which are written with GeomFromText and made NOT NULL for spatial indexing
+GEOM_TYPES = frozenset(["POINT", "POLYGON", "LINESTRING", "MULTIPOLYGON", "GEOMETRY"])
+
+# read_db fetches rows from the cursor in batches of this size
+READ_DB_BATCH_SIZE = 1000
+
+# Queries which cannot reach MariaDB/MySQL (CR_CONN_HOST_ERROR) are tried this many times, waiting
+# CONNECT_RETRY_WAIT seconds after the first failure and doubling up to CONNECT_RETRY_MAX_WAIT
+CONNECT_RETRY_ATTEMPTS = 3
+CONNECT_RETRY_WAIT = 0.5
+CONNECT_RETRY_MAX_WAIT = 5.0
+
+# write_to_db passes rows to executemany in batches of this size, by db_type
+WRITE_CHUNK_SIZES = {"sqlite": 50_000, "mysql": 10_000, "mariadb": 10_000}
+
 logger = logging.getLogger(__name__)
 
 
@@ -75,8 +125,11 @@ def configure_db(
         tables = [tables]
         db_fields = {tables[0]: db_fields}
 
-    if db_config["db_type"] == "sqlite":
+    if _is_memory_db(db_config):
+        _ = _make_connection(db_config)
+    elif db_config["db_type"] == "sqlite":
         if os.path.isfile(db_config["db_path"]) and force:
+            _close_kept_connection(db_config)
             os.remove(db_config["db_path"])
         if not os.path.isdir(os.path.dirname(db_config["db_path"])):
             logging.debug(
@@ -101,6 +154,9 @@ def write_to_db(
     db_fields: Dict,
     table: Union[List, str] = "property_data",
     whatever: bool = False,
+    commit: bool = True,
+    chunk_size: Optional[int] = None,
+    bulk_method: str = "executemany",
 ) -> List[Dict]:
     """
     This function writes a list of rows to a sqlite or MariaDB/MySQL database
@@ -120,6 +176,20 @@ def write_to_db(
        whatever (bool):
             If true each item is tried individually and only those accepted are written,
             list of those not inserted is returned
+       commit (bool):
+            If false the write is not committed, so that several writes on a connection from
+            open_db can be grouped into one transaction. The caller must commit. ValueError is
+            raised for a connection not kept open, which would discard the write
+       chunk_size (int):
+            number of rows passed to each executemany, defaults to WRITE_CHUNK_SIZES for
+            the db_type. All chunks are written in one transaction
+       bulk_method (str):
+            "executemany" (the default) or "load_data". "load_data" writes each chunk to a
+            temporary file which MariaDB/MySQL reads with LOAD DATA LOCAL INFILE, this needs
+            db_bulk_load set in db_config and local_infile enabled on the server. LOAD DATA
+            LOCAL skips rows with duplicate keys, so IntegrityError is raised if fewer rows
+            than were supplied are loaded, by which time the other rows of a MyISAM table
+            have been written
 
     Returns:
        No return value
@@ -147,71 +217,176 @@ def write_to_db(
         return
     db_config = _normalise_config(db_config)
 
-    one_placeholder = ""
-    if db_config["db_type"] == "sqlite":
-        one_placeholder = "?,"
-    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        one_placeholder = "%s,"
+    # Checked before connecting, so that a bad argument leaves no connection or lock behind
+    is_mysql = db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql"
+    if bulk_method not in ["executemany", "load_data"]:
+        raise ValueError("bulk_method must be 'executemany' or 'load_data'")
+    if bulk_method == "load_data" and not (is_mysql and db_config.get("db_bulk_load")):
+        raise ValueError("bulk_method 'load_data' needs MariaDB/MySQL with db_bulk_load set")
+    # Other connections are closed or rolled back into the pool at the end of the call
+    if not commit and not db_config.get("db_keep_open"):
+        raise ValueError("commit=False needs a connection kept open with open_db")
+
+    if chunk_size is None:
+        chunk_size = WRITE_CHUNK_SIZES.get(db_config["db_type"], 10_000)
+
+    insert_statement = _make_insert_statement(table, tuple(db_fields.items()), db_config["db_type"])
+
+    rejected_data = []
+
+    # convert dictionaries or dataclasses to tuples, if required. This is done lazily as the
+    # rows are written so that a converted copy of all of data is never held at once:
+
+    if isinstance(data[0], dict):
+        converted_data = (tuple(row.values()) for row in data)
+    elif dataclasses.is_dataclass(data[0]):
+        # Fetching the fields directly avoids the recursive copy made by dataclasses.asdict
+        field_names = [field.name for field in dataclasses.fields(data[0])]
+        if len(field_names) == 1:
+            converted_data = ((getattr(row, field_names[0]),) for row in data)
+        else:
+            getter = operator.attrgetter(*field_names)
+            converted_data = (getter(row) for row in data)
+    else:
+        converted_data = iter(data)
 
     conn = _make_connection(db_config)
     cursor = conn.cursor()
+    # Take the write lock at the start, rather than part way through, unless the caller
+    # already has a transaction open. MariaDB/MySQL connections are never in autocommit mode
+    if db_config["db_type"] == "sqlite" and not conn.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
 
-    db_insert_root = f"INSERT INTO {table} ("
-    db_insert_middle = ") VALUES ("
-    db_insert_tail = ")"
-
-    db_field_definitions = db_insert_root
-    db_placeholders = db_insert_middle
+    # Whatever goes wrong, chunks already written are rolled back rather than left pending on
+    # the connection, where the next write to it would commit them
+    try:
+        if whatever:
+            for row in converted_data:
+                try:
+                    cursor.execute(insert_statement, row)
+                except (_mysql_driver.IntegrityError, sqlite3.IntegrityError):
+                    rejected_data.append(row)
 
-    for k in db_fields.keys():
-        db_field_definitions = db_field_definitions + k + ","
-        if db_fields[k] in ["POINT", "POLYGON", "LINESTRING", "MULTIPOLYGON", "GEOMETRY"]:
-            db_placeholders = db_placeholders + "GeomFromText(%s),"
         else:
-            db_placeholders = db_placeholders + one_placeholder
+            try:
+                logging.debug(f"Insert statement = {insert_statement}\nData line 1 = {data[0]}")
+                while True:
+                    batch = list(islice(converted_data, chunk_size))
+                    if len(batch) == 0:
+                        break
+                    if bulk_method == "load_data":
+                        _load_data_infile(cursor, table, tuple(db_fields.items()), batch)
+                    else:
+                        cursor.executemany(insert_statement, batch)
+            except _mysql_driver.DataError:
+                logging.info("write_to_db failed with {converted_data}")
+                raise
 
-    insert_statement = db_field_definitions[0:-1] + db_placeholders[0:-1] + db_insert_tail
+        if commit:
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        _release_connection(db_config, conn)
+        raise
 
-    rejected_data = []
+    _release_connection(db_config, conn)
 
-    # convert a list of dictionary to a list of lists, if required:
+    return rejected_data
 
-    converted_data = []
-    if len(data) > 0 and isinstance(data[0], dict):
-        for row in data:
-            converted_data.append([x for x in row.values()])
-    elif len(data) > 0 and dataclasses.is_dataclass(data[0]):
-        for row in data:
-            row_asdict = dataclasses.asdict(row)
-            converted_data.append([x for x in row_asdict.values()])
-    else:
-        converted_data = data
 
-    if whatever:
-        for row in converted_data:
-            try:
-                cursor.execute(insert_statement, row)
-            except (pymysql.err.IntegrityError, sqlite3.IntegrityError):
-                rejected_data.append(row)
+@functools.lru_cache(maxsize=128)
+def _make_insert_statement(table: str, db_fields: tuple, db_type: str) -> str:
+    """
+    This is a private function which builds the INSERT statement for write_to_db, it is cached
+    since do_etl writes the same table with the same fields for every chunk
+    """
+    one_placeholder = ""
+    if db_type == "sqlite":
+        one_placeholder = "?"
+    elif db_type == "mariadb" or db_type == "mysql":
+        one_placeholder = "%s"
+
+    fields = [k for k, _ in db_fields]
+    placeholders = [
+        "GeomFromText(%s)" if field_type in GEOM_TYPES else one_placeholder
+        for _, field_type in db_fields
+    ]
+
+    return f"INSERT INTO {table} ({','.join(fields)}) VALUES ({','.join(placeholders)})"
 
+
+@functools.lru_cache(maxsize=128)
+def _make_load_data_statement(table: str, db_fields: tuple) -> str:
+    """
+    This is a private function which builds the LOAD DATA LOCAL INFILE statement for
+    _load_data_infile, with "{}" left for the file path. Geometry fields are read into user
+    variables and converted with GeomFromText
+    """
+    columns = []
+    geom_settings = []
+    for k, field_type in db_fields:
+        if field_type in GEOM_TYPES:
+            columns.append(f"@{k}")
+            geom_settings.append(f"{k} = GeomFromText(@{k})")
+        else:
+            columns.append(k)
+
+    load_data_statement = (
+        "LOAD DATA LOCAL INFILE '{}' "
+        f"INTO TABLE {table} CHARACTER SET binary "
+        "FIELDS TERMINATED BY ',' ENCLOSED BY '\"' ESCAPED BY '' "
+        "LINES TERMINATED BY '\\n' "
+        f"({','.join(columns)})"
+    )
+    if len(geom_settings) != 0:
+        load_data_statement = load_data_statement + f" SET {','.join(geom_settings)}"
+
+    return load_data_statement
+
+
+def _format_load_data_value(value: Any) -> bytes:
+    """
+    This is a private function which formats a value for a LOAD DATA file, unquoted NULL is read
+    as NULL and quotes within a quoted value are doubled. Text is encoded as UTF-8 and bytes are
+    written as they are, the file is read with CHARACTER SET binary so neither is converted
+    """
+    if value is None:
+        return b"NULL"
+    if isinstance(value, bool):
+        return str(int(value)).encode()
+    if isinstance(value, (int, float)):
+        return str(value).encode()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value)
     else:
-        try:
-            logging.debug(
-                f"Insert statement = {insert_statement}\nData line 1 = {converted_data[0]}"
-            )
-            cursor.executemany(insert_statement, converted_data)
-        except (pymysql.err.IntegrityError, sqlite3.IntegrityError):
-            conn.close()
-            raise
-        except pymysql.err.DataError:
-            conn.close()
-            logging.info("write_to_db failed with {converted_data}")
-            raise
+        value = str(value).encode("utf-8")
+    return b'"' + value.replace(b'"', b'""') + b'"'
 
-    conn.commit()
-    conn.close()
 
-    return rejected_data
+def _load_data_infile(cursor, table: str, db_fields: tuple, rows: List[tuple]):
+    """
+    This is a private function which writes rows to MariaDB/MySQL with LOAD DATA LOCAL INFILE,
+    the server then parses the file directly rather than an INSERT per row. LOAD DATA LOCAL
+    skips duplicate keys with a warning, so a short row count is raised as an IntegrityError
+    as executemany would have done
+    """
+    with tempfile.NamedTemporaryFile("wb", suffix=".csv", delete=False) as load_file:
+        for row in rows:
+            load_file.write(b",".join(_format_load_data_value(x) for x in row) + b"\n")
+
+    try:
+        load_data_path = load_file.name.replace("\\", "/")
+        cursor.execute(_make_load_data_statement(table, db_fields).format(load_data_path))
+    finally:
+        os.remove(load_file.name)
+
+    loaded = cursor.rowcount
+    if loaded != len(rows):
+        raise _mysql_driver.IntegrityError(
+            "LOAD DATA loaded {} of {} rows into {}, the others duplicate existing keys".format(
+                loaded, len(rows), table
+            )
+        )
 
 
 def update_to_db(
@@ -220,6 +395,7 @@ def update_to_db(
     db_fields: Dict,
     table: Union[List, str] = "property_data",
     key: List[str] = ["UPRN"],
+    commit: bool = True,
 ):
     """
     This function updates rows in a sqlite or MariaDB/MySQL database
@@ -239,6 +415,8 @@ def update_to_db(
             name of table to which we are writing, key to db_fields
        key (str):
             the field which forms the key of the update
+       commit (bool):
+            If false the update is not committed, see write_to_db
 
     Returns:
        No return value
@@ -264,27 +442,8 @@ def update_to_db(
 
     db_config = _normalise_config(db_config)
 
-    if db_config["db_type"] == "sqlite":
-        # WHERE KEY1 = ?
-        # WHERE KEY1 = ? AND KEY2 = ?
-        # WHERE KEY1 = ? AND KEY2 = ? AND KEY3 = ?
-        DB_UPDATE_TAIL = " WHERE "
-        joiner = ""
-        for k in key:
-            DB_UPDATE_TAIL = DB_UPDATE_TAIL + "{} {} = ?".format(joiner, k)
-            joiner = "AND"
-        PLACEHOLDER = " = ?,"
-    elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        DB_UPDATE_TAIL = " WHERE "
-        joiner = ""
-        for k in key:
-            DB_UPDATE_TAIL = DB_UPDATE_TAIL + "{} {} = %s".format(joiner, k)
-            joiner = "AND"
-        PLACEHOLDER = " = %s,"
-
-    conn = _make_connection(db_config)
-    cursor = conn.cursor()
-    DB_UPDATE_ROOT = "UPDATE {} SET ".format(table)
+    if not commit and not db_config.get("db_keep_open"):
+        raise ValueError("commit=False needs a connection kept open with open_db")
 
     key_indices = []
     for k in key:
@@ -305,34 +464,66 @@ def update_to_db(
             )
     else:
         converted_data = data
-    for row in converted_data:
-        # print(update_statement, [x for x in row])
-        key_vals = []
-        for k in key_indices:
-            key_vals.append(row[k])
-        update_fields = []
-        update_data = []
-        for i, _ in enumerate(row):
-            if i not in key_indices and row[i] is not None:
-                update_fields.append(db_fields[i])
-                update_data.append(row[i])
-
-        DB_FIELDS = DB_UPDATE_ROOT
-        for k in update_fields:
-            DB_FIELDS = DB_FIELDS + k + PLACEHOLDER
-            update_statement = DB_FIELDS[0:-1] + DB_UPDATE_TAIL
-
-        update_data.extend(key_vals)
-        if len(update_fields) != 0:
+
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+    # Take the write lock at the start, as in write_to_db
+    if db_config["db_type"] == "sqlite" and not conn.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+
+    # Fields which are None in a row are left as they are in the database, so the statement
+    # depends on which fields are set. Consecutive rows setting the same fields go in one
+    # executemany, which keeps the updates in order
+    def set_fields(row):
+        return tuple(i for i, x in enumerate(row) if i not in key_indices and x is not None)
+
+    # As in write_to_db, updates from earlier groups are rolled back if a later one fails
+    try:
+        for update_indices, rows in groupby(converted_data, key=set_fields):
+            if len(update_indices) == 0:
+                continue
+
+            update_statement = _make_update_statement(
+                table,
+                tuple(db_fields[i] for i in update_indices),
+                tuple(key),
+                db_config["db_type"],
+            )
+            update_data = [
+                [row[i] for i in update_indices] + [row[k] for k in key_indices] for row in rows
+            ]
             logging.debug(
-                "Attempting update with statement = '{}' and data = '{}'".format(
-                    update_statement, update_data
+                "Attempting update with statement = '{}' and {} rows, first = '{}'".format(
+                    update_statement, len(update_data), update_data[0]
                 )
             )
-            cursor.execute(update_statement, update_data)
+            cursor.executemany(update_statement, update_data)
 
-    conn.commit()
-    conn.close()
+        if commit:
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        _release_connection(db_config, conn)
+        raise
+
+    _release_connection(db_config, conn)
+
+
+@functools.lru_cache(maxsize=128)
+def _make_update_statement(table: str, update_fields: tuple, key: tuple, db_type: str) -> str:
+    """
+    This is a private function which builds the UPDATE statement for update_to_db, it is cached
+    since the statement only depends on which fields are being set
+    """
+    # UPDATE table SET FIELD1 = ?, FIELD2 = ? WHERE KEY1 = ? AND KEY2 = ?
+    placeholder = "?"
+    if db_type == "mariadb" or db_type == "mysql":
+        placeholder = "%s"
+
+    set_clause = ", ".join(["{} = {}".format(k, placeholder) for k in update_fields])
+    where_clause = " AND ".join(["{} = {}".format(k, placeholder) for k in key])
+
+    return "UPDATE {} SET {} WHERE {}".format(table, set_clause, where_clause)
 
 
 def drop_db_tables(file_path: str, tables: List[str]):
@@ -393,98 +584,194 @@ def finalise_db(
             )
         )
     conn.commit()
-    conn.close()
+    _release_connection(db_config, conn)
 
 
-def read_db(sql_query: str, db_config: Union[str, Dict]) -> Iterable[Dict]:
-    # For MariaDB we need to trap this error:
-    # pymysql.connector.errors.InterfaceError: 2003: Can't connect to MySQL server on
-    # '127.0.0.1:3306'
-    # (10055 An operation on a socket could not be performed because the system lacked sufficient
-    # buffer space or because a queue was full)
-    # This post explains the problem, we're creating too many ephemeral ports
-    # (and not discarding of them properly)
-    # https://blogs.msdn.microsoft.com/sql_protocols/2009/03/09/understanding-the-error-an-operation-on-a-socket-could-not-be-performed-because-the-system-lacked-sufficient-buffer-space-or-because-a-queue-was-full/
-    # At the moment we do this by just adding in a wait
-    db_config = _normalise_config(db_config)
+@contextlib.contextmanager
+def indexes_disabled(db_config: Union[str, Dict], table: str = "property_data"):
+    """
+    This function is a context manager which takes the secondary indexes off a table in a sqlite
+    or MariaDB/MySQL database for a bulk load, so that they are built once at the end rather than
+    updated for every row written
 
-    err_wait = 30.0
+    Args:
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
 
-    if db_config["db_type"] == "sqlite" and not os.path.isfile(db_config["db_path"]):
-        raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
+    Keyword args:
+       table (str):
+            the table whose indexes are to be disabled
+
+    Returns:
+       No return value
+
+    Notes:
+        sqlite indexes are dropped and recreated from their definitions in sqlite_master,
+        indexes made by PRIMARY KEY or UNIQUE constraints are left in place. MariaDB/MySQL
+        uses ALTER TABLE ... DISABLE KEYS, which defers non-unique indexes on MyISAM tables.
+
+    Example:
+        >>> with indexes_disabled(db_file_path, table="test"):
+                write_to_db(data, db_file_path, db_fields, table="test")
+    """
+    db_config = _normalise_config(db_config)
+
+    conn = _make_connection(db_config)
+    cursor = conn.cursor()
+    if db_config["db_type"] == "sqlite":
+        cursor.execute(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,),
+        )
+        indexes = cursor.fetchall()
+        for index_name, _ in indexes:
+            cursor.execute("DROP INDEX {}".format(index_name))
+    else:
+        cursor.execute("ALTER TABLE {} DISABLE KEYS".format(table))
+    conn.commit()
+    _release_connection(db_config, conn)
 
     try:
+        yield
+    finally:
         conn = _make_connection(db_config)
         cursor = conn.cursor()
-        cursor.execute(sql_query)
-    except pymysql.Error as err:
-        if err.args[0] == CR_CONN_HOST_ERROR:
-            timestamp = datetime.datetime.now().isoformat()
-            logger.warning(
-                f"{timestamp}|read_db in ihutilities Caught exception '{err}'. "
-                f"errno = '{err.args[0]}', retry in {err_wait}seconds"
-            )
-            time.sleep(err_wait)
-            conn = _make_connection(db_config)
-            cursor = conn.cursor()
-            cursor.execute(sql_query)
+        if db_config["db_type"] == "sqlite":
+            for index_name, index_sql in indexes:
+                logger.info("Recreating index named '{}' on table '{}'".format(index_name, table))
+                cursor.execute(index_sql)
         else:
-            raise
-    except sqlite3.OperationalError as err:
-        logger.info("Caught exception {} on query '{}'".format(err, sql_query))
-        print("Caught exception {} on query '{}'".format(err, sql_query), flush=True)
-        raise
+            cursor.execute("ALTER TABLE {} ENABLE KEYS".format(table))
+        conn.commit()
+        _release_connection(db_config, conn)
+
+
+def read_db(sql_query: str, db_config: Union[str, Dict]) -> Iterable[Dict]:
+    db_config = _normalise_config(db_config)
+    # MariaDB/MySQL results are streamed from the server, rather than all held in memory. A
+    # streaming cursor blocks its connection until it is exhausted, so a connection kept open
+    # for other statements fetches the whole result as before
+    cursor_class = None
+    is_mysql = db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql"
+    if is_mysql and not db_config.get("db_keep_open"):
+        cursor_class = _mysql_driver.cursors.SSCursor
+    conn, cursor = _execute_query(sql_query, db_config, cursor_class=cursor_class)
 
     if cursor.description is not None:
         colnames = [x[0] for x in cursor.description]
         while True:
-            row = cursor.fetchone()
-            if row is not None:
-                labelled_row = OrderedDict(zip(colnames, row))
-                yield labelled_row
-            else:
-                conn.close()
-                # raise StopIteration # - this is depreciated in Python 3.5 onwards
-                return
+            rows = cursor.fetchmany(READ_DB_BATCH_SIZE)
+            if len(rows) == 0:
+                break
+            # Equivalent to yielding dict(zip(colnames, row)) for each row, with the loop in C
+            yield from map(dict, map(zip, repeat(colnames), rows))
+        cursor.close()
+        _release_connection(db_config, conn)
     else:
         yield cursor.rowcount
         conn.commit()
-        conn.close()
+        _release_connection(db_config, conn)
 
 
-def delete_from_db(sql_query, db_config):
+def read_db_scalar(sql_query: str, db_config: Union[str, Dict]) -> Any:
+    """
+    This function runs a query expected to return a single value, such as a count(*), and
+    returns the first column of the first row without building a dictionary for it
+
+    Args:
+       sql_query (str):
+            The query to run
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Returns:
+       The value, or None if the query returns no rows
+
+    Example:
+        >>> read_db_scalar("select count(*) from test;", db_file_path)
+        3
+    """
+    db_config = _normalise_config(db_config)
+    conn, cursor = _execute_query(sql_query, db_config)
+
+    row = cursor.fetchone()
+    _release_connection(db_config, conn)
+
+    if row is None:
+        return None
+    return row[0]
+
+
+def _execute_query(sql_query: str, db_config: Dict, cursor_class=None):
+    """
+    This is a private function which connects to a database and executes a query for read_db and
+    read_db_scalar, returning the connection and cursor. cursor_class is passed to
+    conn.cursor for MariaDB/MySQL
+    """
+    if (
+        db_config["db_type"] == "sqlite"
+        and not _is_memory_db(db_config)
+        and not os.path.isfile(db_config["db_path"])
+    ):
+        raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
+
+    try:
+        conn, cursor = _connect_and_execute(sql_query, db_config, cursor_class=cursor_class)
+    except sqlite3.OperationalError as err:
+        logger.info("Caught exception {} on query '{}'".format(err, sql_query))
+        print("Caught exception {} on query '{}'".format(err, sql_query), flush=True)
+        raise
+
+    return conn, cursor
+
+
+def _connect_and_execute(sql_query: str, db_config: Dict, cursor_class=None):
+    """
+    This is a private function which connects to a database and executes a query, retrying with
+    an exponential backoff if MariaDB/MySQL cannot be reached
+    """
     # For MariaDB we need to trap this error:
-    # mysql.connector.errors.InterfaceError: 2003: Can't connect to MySQL server on '127.0.0.1:3306'
+    # pymysql.connector.errors.InterfaceError: 2003: Can't connect to MySQL server on
+    # '127.0.0.1:3306'
     # (10055 An operation on a socket could not be performed because the system lacked sufficient
-    # #buffer space or because a queue was full)
+    # buffer space or because a queue was full)
     # This post explains the problem, we're creating too many ephemeral ports
     # (and not discarding of them properly)
     # https://blogs.msdn.microsoft.com/sql_protocols/2009/03/09/understanding-the-error-an-operation-on-a-socket-could-not-be-performed-because-the-system-lacked-sufficient-buffer-space-or-because-a-queue-was-full/
-    # At the moment we do this by just adding in a wait
+    # Pooled connections mostly avoid this, so a short wait is enough for a retry
+    for attempt in range(CONNECT_RETRY_ATTEMPTS):
+        try:
+            conn = _make_connection(db_config)
+            cursor = conn.cursor() if cursor_class is None else conn.cursor(cursor_class)
+            cursor.execute(sql_query)
+            return conn, cursor
+        except _mysql_driver.Error as err:
+            if err.args[0] != CR_CONN_HOST_ERROR or attempt == CONNECT_RETRY_ATTEMPTS - 1:
+                raise
+            err_wait = min(CONNECT_RETRY_WAIT * 2**attempt, CONNECT_RETRY_MAX_WAIT)
+            timestamp = datetime.datetime.now().isoformat()
+            logger.warning(
+                f"{timestamp}|ihutilities Caught exception '{err}'. "
+                f"errno = '{err.args[0]}', retry in {err_wait} seconds"
+            )
+            time.sleep(err_wait)
 
-    db_config = _normalise_config(db_config)
 
-    err_wait = 30.0
+def delete_from_db(sql_query, db_config):
+    db_config = _normalise_config(db_config)
 
-    if db_config["db_type"] == "sqlite" and not os.path.isfile(db_config["db_path"]):
+    if (
+        db_config["db_type"] == "sqlite"
+        and not _is_memory_db(db_config)
+        and not os.path.isfile(db_config["db_path"])
+    ):
         raise IOError("Database file '{}' does not exist".format(db_config["db_path"]))
 
     try:
-        conn = _make_connection(db_config)
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-    except pymysql.Error as err:
-        if err.args[0] == CR_CONN_HOST_ERROR:
-            logger.warning(
-                f"Caught exception '{err}'. errno = '{err.errno}', "
-                f"waiting {err_wait} seconds and having another go"
-            )
-            time.sleep(err_wait)
-            conn = _make_connection(db_config)
-            cursor = conn.cursor()
-            cursor.execute(sql_query)
-        else:
-            raise
+        conn, _ = _connect_and_execute(sql_query, db_config)
     except sqlite3.OperationalError as err:
         logger.info("Caught exception {} on query '{}'".format(err, sql_query))
         print("Caught exception {} on query '{}'".format(err, sql_query), flush=True)
@@ -492,18 +779,143 @@ def delete_from_db(sql_query, db_config):
 
     if conn:
         conn.commit()
-        conn.close()
+        _release_connection(db_config, conn)
 
 
 def delete_db(db_config):
     db_config = _normalise_config(db_config)
     if db_config["db_type"] == "sqlite" and os.path.isfile(db_config["db_path"]):
+        _close_kept_connection(db_config)
         os.remove(db_config["db_path"])
     elif db_config["db_type"] == "mysql":
         conn = _make_connection(db_config)
         cursor = conn.cursor()
         cursor.execute("DROP DATABASE IF EXISTS {}".format(db_config["db_name"]))
         conn.commit()
+        # Pooled connections would otherwise still point at the dropped database
+        conn.close()
+        db_config["db_conn"] = None
+        _clear_mysql_pool(db_config)
+        _mysql_databases_checked.discard(_mysql_pool_key(db_config)[0:3])
+
+
+def open_db(db_config: Union[str, Dict]) -> Dict:
+    """
+    This function opens a connection to a database which is then reused by the other functions
+    in this module, rather than them each making and closing their own, until close_db is called
+
+    Args:
+       db_config (str or dict):
+            For sqlite a file path in a string is sufficient, MariaDB/MySQL require
+            a dictionary and example of which is found in db_config_template
+
+    Returns:
+       db_config structure holding the open connection, which should be passed to subsequent calls
+
+    Example:
+        >>> db_config = open_db(db_file_path)
+        >>> write_to_db(data, db_config, db_fields, table="test")
+        >>> close_db(db_config)
+    """
+    db_config = _normalise_config(db_config)
+    _close_kept_connection(db_config)
+    db_config["db_conn"] = None
+    db_config["db_keep_open"] = True
+    _ = _make_connection(db_config)
+
+    return db_config
+
+
+def close_db(db_config: Dict):
+    """
+    This function closes a connection opened with open_db
+    """
+    _close_kept_connection(db_config)
+    db_config["db_keep_open"] = False
+
+
+def _close_kept_connection(db_config: Dict):
+    """
+    This is a private function which closes a connection held open by open_db
+    """
+    if db_config.get("db_keep_open") and db_config["db_conn"] is not None:
+        db_config["db_conn"].commit()
+        db_config["db_conn"].close()
+        db_config["db_conn"] = None
+
+
+def _release_connection(db_config: Dict, conn):
+    """
+    This is a private function which closes conn, the connection used by an operation, at the
+    end of it unless it is being held open by open_db. MariaDB/MySQL connections go back to the
+    pool. conn is passed in since db_config["db_conn"] may have been replaced by a call made
+    while a read_db generator was part way through
+    """
+    if db_config.get("db_keep_open"):
+        return
+
+    if db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
+        _return_pooled_connection(db_config, conn)
+    else:
+        if db_config["db_conn"] is conn:
+            db_config["db_conn"] = None
+        conn.close()
+
+
+def _mysql_pool_key(db_config: Dict) -> tuple:
+    # Bulk load connections allow LOAD DATA LOCAL INFILE, so they are pooled separately
+    return (
+        db_config["db_host"],
+        db_config["db_user"],
+        db_config["db_name"],
+        bool(db_config.get("db_bulk_load")),
+    )
+
+
+def _get_pooled_connection(db_config: Dict):
+    """
+    This is a private function which returns a live connection from the MariaDB/MySQL pool, or
+    None if there is none
+    """
+    pool = _mysql_pool.get(_mysql_pool_key(db_config))
+    while pool is not None:
+        try:
+            conn = pool.get_nowait()
+        except queue.Empty:
+            return None
+        try:
+            # reconnect is passed positionally since MySQLdb's ping takes no keyword arguments
+            conn.ping(True)
+            return conn
+        except _mysql_driver.Error:
+            logger.debug("Discarding dead pooled connection to {}".format(db_config["db_name"]))
+    return None
+
+
+def _clear_mysql_pool(db_config: Dict):
+    """
+    This is a private function which closes all the pooled connections for a database
+    """
+    for bulk_load in [False, True]:
+        pool = _mysql_pool.pop(_mysql_pool_key({**db_config, "db_bulk_load": bulk_load}), None)
+        while pool is not None and not pool.empty():
+            pool.get_nowait().close()
+
+
+def _return_pooled_connection(db_config: Dict, conn):
+    """
+    This is a private function which hands a MariaDB/MySQL connection back to the pool, ending
+    any open transaction first as closing it would have done. conn is the connection the caller
+    used, db_config["db_conn"] may since have been replaced by an interleaved call
+    """
+    if db_config["db_conn"] is conn:
+        db_config["db_conn"] = None
+    pool = _mysql_pool.setdefault(_mysql_pool_key(db_config), queue.Queue(maxsize=MYSQL_POOL_SIZE))
+    try:
+        conn.rollback()
+        pool.put_nowait(conn)
+    except (_mysql_driver.Error, queue.Full):
+        conn.close()
 
 
 def _normalise_config(db_config: Union[str, Dict]) -> Dict:
@@ -517,19 +929,43 @@ def _normalise_config(db_config: Union[str, Dict]) -> Dict:
         db_config = db_config_template.copy()
         db_config["db_type"] = "sqlite"
         db_config["db_path"] = db_path
+        # An in-memory database only lives as long as its connection
+        if db_path == MEMORY_DB_PATH:
+            db_config["db_keep_open"] = True
     return db_config
 
 
+def _is_memory_db(db_config: Dict) -> bool:
+    return db_config["db_type"] == "sqlite" and db_config["db_path"] == MEMORY_DB_PATH
+
+
 def _make_connection(db_config: Dict) -> sqlite3.Connection:
     """
     This is a private function responsible for making a connection to the database
     """
 
+    if db_config.get("db_keep_open") and db_config["db_conn"] is not None:
+        # An in-memory database cannot be reopened, so a closed one is left to raise on use
+        if _is_memory_db(db_config) or _connection_is_alive(db_config):
+            return db_config["db_conn"]
+        logger.warning("Kept connection to {} was lost, reconnecting".format(_db_name(db_config)))
+
     if db_config["db_type"] == "sqlite":
         db_config["db_conn"] = sqlite3.connect(db_config["db_path"])
+        if db_config.get("db_bulk_load"):
+            for pragma in SQLITE_BULK_LOAD_PRAGMAS:
+                db_config["db_conn"].execute(pragma)
     elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        if not check_mysql_database_exists(db_config):
-            create_mysql_database(db_config)
+        conn = _get_pooled_connection(db_config)
+        if conn is not None:
+            db_config["db_conn"] = conn
+            return conn
+
+        # Only check once per process that the database exists, it needs its own connection
+        if _mysql_pool_key(db_config)[0:3] not in _mysql_databases_checked:
+            if not check_mysql_database_exists(db_config):
+                create_mysql_database(db_config)
+            _mysql_databases_checked.add(_mysql_pool_key(db_config)[0:3])
 
         # This code much fiddled with, essentially I was trying to do my own connection pooling
         # on top of the connectors pooling and it didn't work.
@@ -538,11 +974,12 @@ def _make_connection(db_config: Dict) -> sqlite3.Connection:
         # if db_config["db_conn"] is None or True:
         password = os.environ[db_config["db_pw_environ"]]
         # port = int(os.getenv("MARIA_DB_PORT", "3306"))
-        conn = pymysql.connect(
+        conn = _mysql_driver.connect(
             database=db_config["db_name"],
             user=db_config["db_user"],
             password=password,
             host=db_config["db_host"],
+            local_infile=bool(db_config.get("db_bulk_load")),
         )
         # port=port)
         # pool_name=db_config["db_name"],
@@ -555,16 +992,41 @@ def _make_connection(db_config: Dict) -> sqlite3.Connection:
         # Bit messy, sometimes we make a connection without db existing
         try:
             conn.database = db_config["db_name"]
-        except pymysql.Error as err:
+        except _mysql_driver.Error as err:
             if err.args[0] != BAD_DB_ERROR:
                 raise
 
     return db_config["db_conn"]
 
 
+def _connection_is_alive(db_config: Dict) -> bool:
+    """
+    This is a private function which checks a kept connection is still usable, MariaDB/MySQL
+    connections which have timed out are reconnected in place
+    """
+    conn = db_config["db_conn"]
+    try:
+        if db_config["db_type"] == "sqlite":
+            _ = conn.total_changes
+        else:
+            # Positional reconnect, as in _get_pooled_connection
+            conn.ping(True)
+    except (sqlite3.ProgrammingError, _mysql_driver.Error):
+        return False
+    return True
+
+
+def _db_name(db_config: Dict) -> str:
+    if db_config["db_type"] == "sqlite":
+        return db_config["db_path"]
+    return db_config["db_name"]
+
+
 def create_mysql_database(db_config):
     password = os.environ[db_config["db_pw_environ"]]
-    conn = pymysql.connect(user=db_config["db_user"], password=password, host=db_config["db_host"])
+    conn = _mysql_driver.connect(
+        user=db_config["db_user"], password=password, host=db_config["db_host"]
+    )
     cursor = conn.cursor()
     create_string = (
         "CREATE DATABASE {} DEFAULT CHARACTER SET 'utf8' COLLATE 'utf8_unicode_ci'".format(
@@ -573,7 +1035,7 @@ def create_mysql_database(db_config):
     )
     try:
         cursor.execute(create_string)
-    except pymysql.Error as err:
+    except _mysql_driver.Error as err:
         logger.critical("Failed creating database: {}".format(err))
         logger.critical("Creation command: {}".format(create_string))
         exit(1)
@@ -589,7 +1051,9 @@ def check_mysql_database_exists(db_config):
         )
     )
     password = os.environ[db_config["db_pw_environ"]]
-    conn = pymysql.connect(user=db_config["db_user"], password=password, host=db_config["db_host"])
+    conn = _mysql_driver.connect(
+        user=db_config["db_user"], password=password, host=db_config["db_host"]
+    )
     cursor = conn.cursor()
     cursor.execute(sql_query)
     # conn.commit()
@@ -628,6 +1092,8 @@ def check_table_exists(db_config, table):
     else:
         table_exists = False
 
+    _release_connection(db_config, conn)
+
     return table_exists
 
 
@@ -638,23 +1104,16 @@ def _create_tables_db(
     This is a private function responsible for creating a database table
     """
     if db_config["db_type"] == "sqlite":
-        table_check_query = "SELECT name FROM sqlite_master WHERE type='table' AND name='{}';"
         DB_CREATE_TAIL = ")"
         name = os.path.basename(db_config["db_path"])
     elif db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql":
-        table_check_query = (
-            "SELECT table_name as name FROM information_schema.tables "
-            f"WHERE table_schema = '{db_config['db_name']}'" + " AND table_name = '{}';"
-        )
         DB_CREATE_TAIL = ") ENGINE = MyISAM"
         name = db_config["db_name"]
 
     conn = db_config["db_conn"]
-    cursor = conn.cursor()
+    statements = []
     for table in tables:
-        DB_CREATE_ROOT = "CREATE TABLE {} (".format(table)
-
-        DB_CREATE = DB_CREATE_ROOT
+        column_definitions = []
         primary_keys = []
         for k, v in db_fields[table].items():
             if (
@@ -670,57 +1129,58 @@ def _create_tables_db(
                 v = v.replace("PRIMARY KEY", "")
                 primary_keys.append(k)
 
-            if v in ["POINT", "POLYGON", "LINESTRING", "MULTIPOLYGON", "GEOMETRY"]:
+            if v in GEOM_TYPES:
                 logger.debug(
                     f"Appending NOT NULL to {v} in {table} to allow spatial indexing "
                     "in MariaDB/MySQL [_create_tables_db]"
                 )
-                DB_CREATE = DB_CREATE + " ".join([k, v]) + " NOT NULL,"
+                column_definitions.append(" ".join([k, v]) + " NOT NULL")
             else:
-                DB_CREATE = DB_CREATE + " ".join([k, v]) + ","
+                column_definitions.append(" ".join([k, v]))
 
         # add in the PRIMARY KEY clause
         if len(primary_keys) == 0:
             logger.warning("No primary keys supplied for table '{}'".format(table))
-            DB_CREATE = DB_CREATE[0:-1] + DB_CREATE_TAIL
         else:
-            PRIMARY_KEY_CLAUSE = "PRIMARY KEY ({})".format(",".join(primary_keys))
-            # Since we're using a separate primary key clause we don't need to clip a trailing comma
-            DB_CREATE = DB_CREATE + PRIMARY_KEY_CLAUSE
-            DB_CREATE = DB_CREATE + DB_CREATE_TAIL
+            column_definitions.append("PRIMARY KEY ({})".format(",".join(primary_keys)))
+
+        # IF NOT EXISTS saves a query to check for the table first, existing tables are left as is
+        DB_CREATE = "CREATE TABLE IF NOT EXISTS {} ({}{}".format(
+            table, ",".join(column_definitions), DB_CREATE_TAIL
+        )
 
         if force and db_config["db_type"] == "sqlite":
-            cursor.execute("DROP TABLE IF EXISTS {}".format(table))
+            statements.append("DROP TABLE IF EXISTS {}".format(table))
             logger.warning(
                 "Force is True, so dropping table '{}' in database '{}'".format(table, name)
             )
         elif force and (db_config["db_type"] == "mariadb" or db_config["db_type"] == "mysql"):
-            cursor.execute("DROP TABLE IF EXISTS `{}`.`{}`;".format(db_config["db_name"], table))
+            statements.append("DROP TABLE IF EXISTS `{}`.`{}`".format(db_config["db_name"], table))
             logger.warning(
                 "Force is True, so dropping table '{}' in database '{}'".format(table, name)
             )
 
-        cursor.execute(table_check_query.format(table))
-        result = cursor.fetchall()
-        logger.debug("table_check_query result: {}".format(result))
-        if len(result) != 0 and result[0][0].lower() == table.lower():
-            table_exists = True
-        else:
-            table_exists = False
+        logger.debug("Creating table {} with statement: \n{}".format(table, DB_CREATE))
+        statements.append(DB_CREATE)
 
-        if not table_exists:
-            logger.debug("Creating table {} with statement: \n{}".format(table, DB_CREATE))
-            try:
-                cursor.execute(DB_CREATE)
-            except:  # noqa: E722 do not use bare 'except'
-                logger.debug(
-                    "Database create statement failed: '{}' for database '{}'".format(
-                        DB_CREATE, name
-                    )
-                )
-                raise
-        else:
-            logger.warning("Table '{}' already exists in database '{}'".format(table, name))
+    # sqlite runs all the DDL as one script, MariaDB/MySQL connections do not allow multiple
+    # statements in one execute so run them in turn. executescript commits first, so it is only
+    # used on a connection opened for this call, not one kept open with work pending on it
+    if db_config["db_type"] == "sqlite" and not db_config.get("db_keep_open"):
+        ddl_batches = [";\n".join(statements) + ";"]
+        execute = conn.executescript
+    else:
+        ddl_batches = statements
+        execute = conn.cursor().execute
+
+    for ddl in ddl_batches:
+        try:
+            execute(ddl)
+        except:  # noqa: E722 do not use bare 'except'
+            logger.debug(
+                "Database create statement failed: '{}' for database '{}'".format(ddl, name)
+            )
+            raise
 
     db_config["db_conn"].commit()
-    db_config["db_conn"].close()
+    _release_connection(db_config, conn)
@@ -11,10 +11,12 @@ import fnmatch
 import hashlib
 import io
 import logging
+import mmap
 import os
 import shutil
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple, TextIO, Generator
 from pathlib import Path
 
@@ -28,6 +30,12 @@ logger = logging.getLogger(__name__)
 
 config = Config(connect_timeout=900, read_timeout=900, retries={"max_attempts": 3})
 
+# Files smaller than this are hashed from a single read rather than a memory map
+MMAP_SHA_THRESHOLD = 64 * 1024
+
+# Zip members, which can't be memory mapped, are hashed in blocks of this size
+SHA_READ_SIZE = 1 << 20
+
 
 def create_s3_client(
     profile_name: Optional[str] = None,
@@ -243,11 +251,52 @@ def _write_dictionary_to_local_file(
     status = _make_write_dictionary_status(append, filepath, newfile)
     if not append and not newfile:
         os.remove(filepath)
-        newfile = True
 
-    with open(filepath, "a", encoding=encoding, errors="ignore") as output_file:
-        dict_writer = csv.DictWriter(
-            output_file,
+    with DictCsvAppender(
+        filepath, keys, delimiter=delimiter, quoting=quoting, encoding=encoding
+    ) as appender:
+        appender.writerows(data)
+
+    return status
+
+
+class DictCsvAppender:
+    """This class keeps a local CSV file open for appending dictionaries, so that repeated writes
+    do not each check for the file, reopen it and decide whether to write a header
+
+    Args:
+        filepath (str):
+            path to the CSV file, a header is written if the file does not yet exist
+        keys (list):
+            the column names, in order
+
+    Keyword args:
+        delimiter, quoting, encoding:
+            as for write_dictionary
+        buffering (int):
+            size of the write buffer in bytes
+
+    Example:
+        >>> with DictCsvAppender("output.csv", ["a", "b"]) as appender:
+        >>>     for chunk in chunks:
+        >>>         appender.writerows(chunk)
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        keys: List[str],
+        delimiter: str = ",",
+        quoting: int = csv.QUOTE_MINIMAL,
+        encoding: str = "utf-8",
+        buffering: int = 64 * 1024,
+    ):
+        newfile = not os.path.isfile(filepath)
+        self._output_file = open(
+            filepath, "a", encoding=encoding, errors="ignore", buffering=buffering
+        )
+        self._dict_writer = csv.DictWriter(
+            self._output_file,
             keys,
             lineterminator="\n",
             delimiter=delimiter,
@@ -255,10 +304,22 @@ def _write_dictionary_to_local_file(
             escapechar="\\",
         )
         if newfile:
-            dict_writer.writeheader()
-        dict_writer.writerows(data)
+            self._dict_writer.writeheader()
 
-    return status
+    def writerow(self, row: Dict[str, Any]):
+        self._dict_writer.writerow(row)
+
+    def writerows(self, rows: List[Dict[str, Any]]):
+        self._dict_writer.writerows(rows)
+
+    def close(self):
+        self._output_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def _write_dictionary_to_s3(
@@ -317,8 +378,25 @@ def _make_write_dictionary_status(append: bool, filepath: str, newfile: bool) ->
     return status
 
 
-def calculate_file_sha(filepath: str, encoding="utf-8-sig"):
-    file_sha = hashlib.sha1()
+def calculate_file_sha(filepath: str, encoding="utf-8-sig", algorithm="sha1"):
+    """This function calculates a fingerprint for a file, even if a file is within a zip
+
+    Args:
+        filepath (str):
+            file path which may point to a file inside a zip
+
+    Keyword args:
+        encoding (str):
+            character encoding of the target file
+        algorithm (str):
+            any hashlib algorithm name, i.e. "sha256" or "blake2b". Digests for algorithms
+            other than the default "sha1" are prefixed with the algorithm name so that
+            fingerprints made with different algorithms never match
+
+    Returns:
+       a hex digest, or None if the file is not found
+    """
+    file_sha = hashlib.new(algorithm)
 
     # Switched this to get sha calculation for files within zip files working
     # fh = file_handle_or_none(filepath, encoding=None, mode="rb")
@@ -348,10 +426,53 @@ def calculate_file_sha(filepath: str, encoding="utf-8-sig"):
 
     # with open(filepath, "rb") as f:
     with fh:
-        for chunk in iter(lambda: fh.read(4096), b""):
-            file_sha.update(chunk)
+        if isinstance(fh, io.BufferedReader) and file_size >= MMAP_SHA_THRESHOLD:
+            # Hashing a memory map of a plain file saves copying it through a read buffer
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                file_sha.update(mm)
+        elif isinstance(fh, io.BufferedReader):
+            file_sha.update(fh.read())
+        else:
+            # Reading into one reused buffer avoids allocating a new bytes object per block
+            buffer = bytearray(SHA_READ_SIZE)
+            view = memoryview(buffer)
+            for size in iter(lambda: fh.readinto(buffer), 0):
+                file_sha.update(view[:size])
+
+    if algorithm == "sha1":
+        return file_sha.hexdigest()
+
+    return "{}:{}".format(algorithm, file_sha.hexdigest())
 
-    return file_sha.hexdigest()
+
+def calculate_file_shas(
+    filepaths: List[str],
+    encoding="utf-8-sig",
+    algorithm="sha1",
+    max_workers: Optional[int] = None,
+) -> Dict[str, Optional[str]]:
+    """This function calculates fingerprints for several files at once, using a pool of threads
+    since hashlib releases the GIL whilst hashing large buffers
+
+    Args:
+        filepaths (list of str):
+            file paths, as for calculate_file_sha
+
+    Keyword args:
+        encoding, algorithm:
+            as for calculate_file_sha
+        max_workers (int):
+            the number of threads, defaults to that chosen by ThreadPoolExecutor
+
+    Returns:
+       a dictionary of file path to hex digest, or None where a file is not found
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        file_shas = executor.map(
+            lambda filepath: calculate_file_sha(filepath, encoding=encoding, algorithm=algorithm),
+            filepaths,
+        )
+        return dict(zip(filepaths, file_shas))
 
 
 def get_a_file_handle(
@@ -359,6 +480,8 @@ def get_a_file_handle(
     encoding: Optional[str] = "utf-8-sig",
     mode: Optional[str] = "r",
     zip_guess: Optional[bool] = True,
+    buffering: int = -1,
+    newline: Optional[str] = None,
 ):
     """This function returns a file handle, even if a file is within a zip
 
@@ -373,6 +496,11 @@ def get_a_file_handle(
             mode to use for opening file
         zip_guess (bool):
             if True then we try to guess whether the file is a zip
+        buffering (int):
+            size of the read buffer in bytes, -1 gives the default buffer size
+        newline (str):
+            newline handling for text mode, as for the built in open. The csv module
+            expects newline=""
 
     Returns:
        a file handler
@@ -387,9 +515,11 @@ def get_a_file_handle(
 
     if ".zip" not in file_path.lower():
         if mode == "r":
-            fh = file_handle_or_none(file_path, encoding=encoding, mode=mode)
+            fh = file_handle_or_none(
+                file_path, encoding=encoding, mode=mode, buffering=buffering, newline=newline
+            )
         else:  # This is what we do for binary files, no encoding permitted here
-            fh = file_handle_or_none(file_path, encoding=None, mode=mode)
+            fh = file_handle_or_none(file_path, encoding=None, mode=mode, buffering=buffering)
     else:
         zip_path, name_in_zip = split_zipfile_path(file_path)
         zf = zipfile.ZipFile(zip_path)
@@ -400,10 +530,7 @@ def get_a_file_handle(
                 cf = zf.open(namelist[0], "r")
             except (NotImplementedError, OSError):
                 raise
-            if mode == "r":
-                fh = io.TextIOWrapper(io.BytesIO(cf.read()), encoding=encoding)
-            else:
-                fh = io.BytesIO(cf.read())
+            fh = _wrap_zip_member(cf, encoding, mode, buffering, newline)
         else:
             for name in namelist:
                 if fnmatch.fnmatch(name, name_in_zip):
@@ -411,20 +538,30 @@ def get_a_file_handle(
                         cf = zf.open(name, "r")
                     except (NotImplementedError, OSError):
                         raise
-                    if mode == "r":
-                        fh = io.TextIOWrapper(io.BytesIO(cf.read()), encoding=encoding)
-                    else:
-                        fh = io.BytesIO(cf.read())
+                    fh = _wrap_zip_member(cf, encoding, mode, buffering, newline)
+
+    return fh
 
+
+def _wrap_zip_member(cf, encoding, mode, buffering, newline):
+    # The zip member is streamed rather than read into memory in one go
+    if buffering > 0:
+        cf = io.BufferedReader(cf, buffer_size=buffering)
+    if mode == "r":
+        fh = io.TextIOWrapper(cf, encoding=encoding, newline=newline)
+    else:
+        fh = cf
     return fh
 
 
-def file_handle_or_none(file_path, encoding="utf-8-sig", mode="r") -> Any:
+def file_handle_or_none(
+    file_path, encoding="utf-8-sig", mode="r", buffering=-1, newline=None
+) -> Any:
     try:
         if encoding is not None:
-            fh = open(file_path, encoding=encoding, mode=mode)
+            fh = open(file_path, encoding=encoding, mode=mode, buffering=buffering, newline=newline)
         else:
-            fh = open(file_path, mode=mode)
+            fh = open(file_path, mode=mode, buffering=buffering)
     except FileNotFoundError:
         fh = None
     return fh
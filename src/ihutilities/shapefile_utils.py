@@ -28,6 +28,8 @@ shapetype_lookup = {
     31: "MultiPatch",
 }
 
+_BBOX_POLYGON_FORMAT = "POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))".format
+
 
 def load_shapefile_data(data_path):
     """This function loads a shapefile into a reader
@@ -62,20 +64,8 @@ def make_bbox_polygon(shp_bbox):
        polygon (str):
 
     """
-    bb_str = [str(round(x, 1)) for x in shp_bbox]
-    bb_polygon = (
-        " ".join([bb_str[0], bb_str[1]])
-        + ","
-        + " ".join([bb_str[2], bb_str[1]])
-        + ","
-        + " ".join([bb_str[2], bb_str[3]])
-        + ","
-        + " ".join([bb_str[0], bb_str[3]])
-        + ","
-        + " ".join([bb_str[0], bb_str[1]])
-    )
-
-    polygon = "POLYGON(({}))".format(bb_polygon)
+    bb_str = [str(round(x, 1)) for x in shp_bbox[:4]]
+    polygon = _BBOX_POLYGON_FORMAT(*bb_str)
     return polygon
 
 
@@ -89,20 +79,9 @@ def make_multipolygon(points, parts, decimate_threshold=None):
 
     list_of_polygons = _convert_parts(points, parts, decimate_threshold=decimate_threshold)
 
-    polygons = ""
-
-    for i, points in enumerate(list_of_polygons):
-        origin = points[0]
-        polygon = "(("
-        for i, point in enumerate(points):
-            polygon = polygon + str(round(point[0], 0)) + " " + str(round(point[1], 0)) + ", "
-
-        polygon = polygon + str(round(origin[0], 0)) + " " + str(round(origin[1], 0)) + ")),"
+    polygons = ",".join("(({}))".format(_make_ring(points)) for points in list_of_polygons)
 
-        polygons = polygons + polygon
-        # print(polygon[:100], flush=True)
-
-    output_polygon = prefix + polygons[:-1] + suffix
+    output_polygon = prefix + polygons + suffix
 
     # print(output_polygon)
     return output_polygon
@@ -118,25 +97,21 @@ def make_polygon(points, parts, decimate_threshold=None):
 
     list_of_polygons = _convert_parts(points, parts, decimate_threshold=decimate_threshold)
 
-    polygons = ""
-
-    for i, points in enumerate(list_of_polygons):
-        origin = points[0]
-        polygon = "("
-        for i, point in enumerate(points):
-            polygon = polygon + str(round(point[0], 0)) + " " + str(round(point[1], 0)) + ", "
+    polygons = ",".join("({})".format(_make_ring(points)) for points in list_of_polygons)
 
-        polygon = polygon + str(round(origin[0], 0)) + " " + str(round(origin[1], 0)) + "),"
-
-        polygons = polygons + polygon
-        # print(polygon[:100], flush=True)
-
-    output_polygon = prefix + polygons[:-1] + suffix
+    output_polygon = prefix + polygons + suffix
 
     # print(output_polygon)
     return output_polygon
 
 
+def _make_ring(points):
+    # Coordinates are rounded to whole units and the ring is closed by repeating its first point
+    coordinates = ["{} {}".format(round(point[0], 0), round(point[1], 0)) for point in points]
+    coordinates.append(coordinates[0])
+    return ", ".join(coordinates)
+
+
 def make_linestring(shp_points):
     linestring = "LineString("
     for point in shp_points:
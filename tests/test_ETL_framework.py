@@ -8,12 +8,13 @@ from collections import OrderedDict
 
 from ihutilities.ETL_framework import (
     do_etl,
+    do_etl_many,
     report_input_length,
     check_if_already_done,
     get_source_generator,
 )
 
-from ihutilities import read_db
+from ihutilities import read_db, read_db_scalar
 
 
 class TestETLFramework(unittest.TestCase):
@@ -54,7 +55,46 @@ class TestETLFramework(unittest.TestCase):
         )
         assert status == "Completed"
 
+    def test_do_etl_with_hand_built_db_config(self):
+        db_config = {"db_type": "sqlite", "db_path": self.db_config, "db_conn": None}
+        _, status = do_etl(
+            self.DB_FIELDS,
+            db_config,
+            self.datapath,
+            self.data_field_lookup,
+            mode="production",
+            force=True,
+        )
+        row_count = read_db_scalar("select count(*) from property_data", self.db_config)
+
+        assert status == "Completed"
+        assert row_count == 35
+
     def test_do_etl_two_stage(self):
+        db_config, status = do_etl(
+            self.DB_FIELDS,
+            ":memory:",
+            self.datapath,
+            self.data_field_lookup,
+            mode="production",
+            force=True,
+        )
+        db_config, status = do_etl(
+            self.DB_FIELDS,
+            db_config,
+            self.datapath2,
+            self.data_field_lookup,
+            mode="production",
+            force=False,
+        )
+        # Check for stages one and two in the metadata table
+        sql_query = "select SequenceNumber from metadata"
+        results = list(read_db(sql_query, db_config))
+        sequence_numbers = {x["SequenceNumber"] for x in results}
+
+        assert sequence_numbers == set([1, 2])
+
+    def test_do_etl_falls_back_without_csv_extension(self):
         _, status = do_etl(
             self.DB_FIELDS,
             self.db_config,
@@ -62,26 +102,72 @@ class TestETLFramework(unittest.TestCase):
             self.data_field_lookup,
             mode="production",
             force=True,
+            csv_extension=os.path.join(self.test_root, "fixtures", "no_such_extension"),
         )
+        row_count = read_db_scalar("select count(*) from property_data", self.db_config)
+
+        assert status == "Completed"
+        assert row_count == 35
+
+    @unittest.skipIf("SQLITE_CSV_EXTENSION" not in os.environ, "SQLITE_CSV_EXTENSION is not set")
+    def test_do_etl_with_csv_extension(self):
         _, status = do_etl(
             self.DB_FIELDS,
             self.db_config,
-            self.datapath2,
+            self.datapath,
             self.data_field_lookup,
             mode="production",
-            force=False,
+            force=True,
+            csv_extension=os.environ["SQLITE_CSV_EXTENSION"],
+        )
+        row_count = read_db_scalar("select count(*) from property_data", self.db_config)
+
+        assert status == "Completed"
+        assert row_count == 35
+
+    def test_do_etl_many(self):
+        _, statuses = do_etl_many(
+            self.DB_FIELDS,
+            self.db_config,
+            [self.datapath, self.datapath2],
+            self.data_field_lookup,
+            max_workers=2,
+            mode="production",
+            force=True,
         )
-        # Check for stages one and two in the metadata table
         sql_query = "select SequenceNumber from metadata"
         results = list(read_db(sql_query, self.db_config))
         sequence_numbers = {x["SequenceNumber"] for x in results}
 
+        assert statuses == ["Completed", "Completed"]
         assert sequence_numbers == set([1, 2])
 
-    def test_do_etl_session_log(self):
-        _, status = do_etl(
+    def test_do_etl_many_skips_files_already_done(self):
+        do_etl(
+            self.DB_FIELDS,
+            self.db_config,
+            self.datapath,
+            self.data_field_lookup,
+            mode="production",
+            force=True,
+        )
+        _, statuses = do_etl_many(
             self.DB_FIELDS,
             self.db_config,
+            [self.datapath, self.datapath2],
+            self.data_field_lookup,
+            max_workers=2,
+            mode="production",
+        )
+        row_count = read_db_scalar("select count(*) from property_data", self.db_config)
+
+        assert statuses == ["Already done", "Completed"]
+        assert row_count == 70
+
+    def test_do_etl_session_log(self):
+        db_config, status = do_etl(
+            self.DB_FIELDS,
+            ":memory:",
             self.datapath,
             self.data_field_lookup,
             mode="test",
@@ -91,7 +177,7 @@ class TestETLFramework(unittest.TestCase):
         )
         mod_config, status = do_etl(
             self.DB_FIELDS,
-            self.db_config,
+            db_config,
             self.datapath,
             self.data_field_lookup,
             mode="test",
@@ -157,6 +243,13 @@ class TestETLFramework(unittest.TestCase):
         )
         self.assertEqual(file_length, 35)
 
+    def test_report_input_length_with_headers_matches_parsed_rows(self):
+        file_length = report_input_length(
+            get_source_generator, 1000, self.datapath, True, ",", "utf-8-sig"
+        )
+        parsed_rows = list(get_source_generator(self.datapath, True, ",", "utf-8-sig"))
+        self.assertEqual(file_length, len(parsed_rows) - 1)
+
     def test_etl_from_zip(self):
         test_root = os.path.dirname(__file__)
         datapath = os.path.join(test_root, "fixtures", "survey_csv.zip")
@@ -201,10 +294,9 @@ class TestETLFramework(unittest.TestCase):
         )
         # check for sessions 1 and 2 in the session log, check we have 35 lines in the data table
         # Check for stages one and two in the metadata table
-        sql_query = "select count(*) as cnt from property_data"
-        results = list(read_db(sql_query, mod_config))
+        sql_query = "select count(*) from property_data"
 
-        assert results[0]["cnt"] == 70
+        assert read_db_scalar(sql_query, mod_config) == 70
 
 
 def make_row(
@@ -2,16 +2,22 @@
 # encoding, utf-8
 
 import os
+import sqlite3
 import unittest
 
 from collections import OrderedDict
 
 from ihutilities.ETL_framework import (
     make_point,
+    make_points,
     report_input_length,
     get_primary_key_from_db_fields,
     get_source_generator,
     make_row,
+    make_row_factory,
+    compile_rowmaker,
+    _make_stage_select,
+    _load_from_stage,
 )
 
 
@@ -51,6 +57,16 @@ class TestETLUnits(unittest.TestCase):
         point = make_point(row, data_field_lookup)
         self.assertEqual(point, "POINT(123456.0 654321.0)")
 
+    def test_make_points(self):
+        rows = [
+            {"id": 1, "Easting": 123456, "Northing": 654321},
+            {"id": 2, "Easting": "", "Northing": "1.5"},
+        ]
+        data_field_lookup = ["Easting", "Northing"]
+        points = make_points(rows, data_field_lookup)
+        self.assertEqual(points, ["POINT(123456.0 654321.0)", "POINT(0 1.5)"])
+        self.assertEqual(points[0], make_point(rows[0], data_field_lookup))
+
     def test_report_input_length(self):
         test_line_limit = 1000
         file_length = report_input_length(
@@ -58,6 +74,27 @@ class TestETLUnits(unittest.TestCase):
         )
         self.assertEqual(file_length, 35)
 
+    def test_report_input_length_for_zip_member(self):
+        datapath = os.path.join(self.test_root, "fixtures", "survey_csv.zip")
+        file_length = report_input_length(
+            get_source_generator, 1000, datapath, False, ",", "utf-8-sig"
+        )
+        self.assertEqual(file_length, 35)
+
+    def test_report_input_length_skips_blank_lines(self):
+        datapath = os.path.join(self.test_root, "temp", "blank_lines.csv")
+        with open(datapath, "wb") as f:
+            f.write(b"Letter,Number\r\n\r\nA,1\r\n\n\nB,2\nC,3\n\n")
+
+        def parsing_rowsource(data_path, headers, separator, encoding):
+            return get_source_generator(data_path, headers, separator, encoding)
+
+        file_length = report_input_length(get_source_generator, 1000, datapath, True, ",", None)
+        parsed_length = report_input_length(parsing_rowsource, 1000, datapath, True, ",", None)
+        os.remove(datapath)
+
+        self.assertEqual(file_length, parsed_length)
+
     def test_get_primary_key_from_db_fields(self):
         primary_key = get_primary_key_from_db_fields(self.DB_FIELDS)
         self.assertEqual(primary_key, "ID")
@@ -100,3 +137,101 @@ class TestETLUnits(unittest.TestCase):
             autoinc,
             primary_key,
         )
+
+    def test_make_row_factory_matches_make_row(self):
+        autoinc_lookup = self.data_field_lookup.copy()
+        autoinc_lookup["ID"] = None
+        rowmaker = make_row_factory(autoinc_lookup, self.DB_FIELDS, [""], True, "ID")
+        input_rows = [{"Letter": "A", "Number": 1}, {"Letter": "", "Number": 2}]
+
+        for input_row in input_rows:
+            self.assertEqual(
+                rowmaker(input_row),
+                make_row(input_row, "", autoinc_lookup, self.DB_FIELDS, [""], True, "ID"),
+            )
+        self.assertEqual(rowmaker(input_rows[1]), {"ID": None, "Letter": None, "Number": 2})
+
+    def test_compile_rowmaker_returns_a_tuple_in_db_fields_order(self):
+        input_row = {"ID": "7", "Letter": "-", "Number": "1,000"}
+        db_fields = OrderedDict(
+            [
+                ("ID", "INTEGER PRIMARY KEY"),
+                ("Letter", "TEXT"),
+                ("Number", "INTEGER"),
+            ]
+        )
+        rowmaker = compile_rowmaker(db_fields, self.data_field_lookup, ["-"], False, "ID")
+
+        data_row = rowmaker(input_row)
+
+        self.assertEqual(data_row, ("7", None, 1000))
+
+    def test_get_source_generator_with_headers_makes_dictionaries(self):
+        rows = list(get_source_generator(self.datapath, True, ",", "utf-8-sig"))
+
+        self.assertEqual(len(rows), 35)
+        self.assertEqual(rows[0], {"ID": "1", "Letter": "A", "Number": "1"})
+
+    def test_compile_rowmaker_makes_points(self):
+        input_row = {"ID": "1", "Easting": "123456", "Northing": "654321"}
+        db_fields = OrderedDict([("ID", "INTEGER PRIMARY KEY"), ("location", "POINT")])
+        data_field_lookup = {"ID": "ID", "location": ["Easting", "Northing"]}
+        rowmaker = compile_rowmaker(db_fields, data_field_lookup, [""], False, "ID")
+
+        data_row = rowmaker(input_row)
+
+        self.assertEqual(data_row, ("1", "POINT(123456.0 654321.0)"))
+
+    def test_compile_rowmaker_passes_unhashable_values(self):
+        rowmaker = compile_rowmaker(
+            self.DB_FIELDS, {"ID": "ID", "Letter": None, "Number": None}, ["-"], False, "ID"
+        )
+        data_row = rowmaker({"ID": ["1", "extra"]})
+
+        self.assertEqual(data_row, (["1", "extra"], None, None))
+
+    def _make_stage(self, rows):
+        conn = sqlite3.connect(":memory:")
+        conn.execute(
+            "CREATE TABLE property_data (ID INTEGER PRIMARY KEY, Letter TEXT, Number TEXT)"
+        )
+        conn.execute("CREATE TABLE temp.etl_stage (ID, Letter, Number)")
+        conn.executemany("INSERT INTO temp.etl_stage VALUES (?, ?, ?)", rows)
+        stage_select = _make_stage_select(
+            self.DB_FIELDS, self.data_field_lookup, ["-"], False, "ID"
+        )
+        return conn, stage_select
+
+    def test_load_from_stage(self):
+        conn, stage_select = self._make_stage([("1", "A", "1"), ("2", "-", "4")])
+
+        fast_load = _load_from_stage(
+            conn, "property_data", stage_select, self.data_field_lookup, "ID"
+        )
+        rows = conn.execute("SELECT * FROM property_data ORDER BY ID").fetchall()
+
+        self.assertEqual(fast_load, (2, 0))
+        self.assertEqual(rows, [(1, "A", "1"), (2, None, "4")])
+
+    def test_load_from_stage_declines_repeated_keys(self):
+        conn, stage_select = self._make_stage([("1", "A", "1"), ("1", "B", "4")])
+
+        fast_load = _load_from_stage(
+            conn, "property_data", stage_select, self.data_field_lookup, "ID"
+        )
+        row_count = conn.execute("SELECT count(*) FROM property_data").fetchone()[0]
+
+        self.assertIsNone(fast_load)
+        self.assertEqual(row_count, 0)
+
+    def test_load_from_stage_declines_existing_keys(self):
+        conn, stage_select = self._make_stage([("2", "B", "2"), ("1", "A", "1")])
+        conn.execute("INSERT INTO property_data VALUES (1, 'Z', '0')")
+
+        fast_load = _load_from_stage(
+            conn, "property_data", stage_select, self.data_field_lookup, "ID"
+        )
+        rows = conn.execute("SELECT * FROM property_data").fetchall()
+
+        self.assertIsNone(fast_load)
+        self.assertEqual(rows, [(1, "Z", "0")])
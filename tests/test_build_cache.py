@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import functools
+import os
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+from unittest import TestCase
+
+import pytest
+
+from ihutilities import read_db, read_db_scalar
+from ihutilities.build_cache import build_cache, bulk_insert, get_max_params
+
+CACHE_DB_PATH = os.path.join(Path(__file__).parents[0], "temp", "test.sqlite")
+
+CACHE_FIELDS = OrderedDict([("UPRN", "INTEGER PRIMARY KEY"), ("Value", "TEXT")])
+
+KEYS = list(range(1, 26))
+
+
+def key_generator(chunk_size):
+    for i in range(0, len(KEYS), chunk_size):
+        end = i + chunk_size
+        yield KEYS[i:end]
+
+
+def key_count():
+    return len(KEYS)
+
+
+def make_row(key, fail_at=None):
+    if key == fail_at:
+        raise ValueError("Failed at key {}".format(key))
+    return (key, "value {}".format(key))
+
+
+def test_build_cache():
+    if os.path.isfile(CACHE_DB_PATH):
+        os.remove(CACHE_DB_PATH)
+
+    cache_db = build_cache(
+        [(key_generator, key_count, make_row)],
+        CACHE_DB_PATH,
+        CACHE_FIELDS,
+        "sha",
+        chunk_size=10,
+        test=True,
+    )
+
+    rows = list(read_db("select * from property_data order by UPRN", cache_db))
+    metadata = list(read_db("select * from metadata", cache_db))
+    session_log = list(read_db("select * from session_log", cache_db))
+    journal_mode = read_db_scalar("PRAGMA journal_mode;", cache_db)
+    page_size = read_db_scalar("PRAGMA page_size;", cache_db)
+    os.remove(cache_db)
+
+    TestCase().assertEqual([row["UPRN"] for row in rows], KEYS)
+    TestCase().assertEqual(metadata[0]["status"], "Complete")
+    TestCase().assertEqual(metadata[0]["chunk_count"], 3)
+    TestCase().assertEqual(metadata[0]["line_count"], len(KEYS))
+    TestCase().assertEqual(session_log[0]["last_chunk"], 3)
+    TestCase().assertEqual(journal_mode, "wal")
+    TestCase().assertEqual(page_size, 8192)
+
+
+def test_build_cache_with_process_pool():
+    if os.path.isfile(CACHE_DB_PATH):
+        os.remove(CACHE_DB_PATH)
+
+    cache_db = build_cache(
+        [(key_generator, key_count, make_row)],
+        CACHE_DB_PATH,
+        CACHE_FIELDS,
+        "sha",
+        chunk_size=10,
+        test=True,
+        max_workers=2,
+    )
+
+    rows = list(read_db("select * from property_data order by UPRN", cache_db))
+    os.remove(cache_db)
+
+    TestCase().assertEqual(
+        [(row["UPRN"], row["Value"]) for row in rows], [make_row(key) for key in KEYS]
+    )
+
+
+def test_build_cache_with_make_rows_batch():
+    if os.path.isfile(CACHE_DB_PATH):
+        os.remove(CACHE_DB_PATH)
+
+    def make_rows_batch(keys):
+        return [make_row(key) for key in keys]
+
+    cache_db = build_cache(
+        [(key_generator, key_count, make_row, make_rows_batch)],
+        CACHE_DB_PATH,
+        CACHE_FIELDS,
+        "sha",
+        chunk_size=10,
+        test=True,
+    )
+
+    rows = list(read_db("select * from property_data order by UPRN", cache_db))
+    os.remove(cache_db)
+
+    TestCase().assertEqual(
+        [(row["UPRN"], row["Value"]) for row in rows], [make_row(key) for key in KEYS]
+    )
+
+
+def test_build_cache_resumes_after_last_written_chunk():
+    if os.path.isfile(CACHE_DB_PATH):
+        os.remove(CACHE_DB_PATH)
+
+    failing_make_row = functools.partial(make_row, fail_at=15)
+    with pytest.raises(ValueError):
+        build_cache(
+            [(key_generator, key_count, failing_make_row)],
+            CACHE_DB_PATH,
+            CACHE_FIELDS,
+            "sha",
+            chunk_size=10,
+            test=True,
+        )
+
+    cache_db = build_cache(
+        [(key_generator, key_count, make_row)],
+        CACHE_DB_PATH,
+        CACHE_FIELDS,
+        "sha",
+        chunk_size=10,
+        test=True,
+    )
+
+    rows = list(read_db("select * from property_data order by UPRN", cache_db))
+    session_log = list(read_db("select * from session_log order by ID", cache_db))
+    os.remove(cache_db)
+
+    TestCase().assertEqual([row["UPRN"] for row in rows], KEYS)
+    TestCase().assertEqual(session_log[-1]["first_chunk"], "1")
+    TestCase().assertEqual(session_log[-1]["last_chunk"], 3)
+
+
+def test_build_cache_raises_errors_from_writer():
+    if os.path.isfile(CACHE_DB_PATH):
+        os.remove(CACHE_DB_PATH)
+
+    def repeated_key_generator(chunk_size):
+        yield KEYS[0:chunk_size]
+        yield KEYS[0:chunk_size]
+
+    with pytest.raises(sqlite3.IntegrityError):
+        build_cache(
+            [(repeated_key_generator, key_count, make_row)],
+            CACHE_DB_PATH,
+            CACHE_FIELDS,
+            "sha",
+            chunk_size=10,
+            test=True,
+        )
+
+    chunk_count = read_db_scalar("select chunk_count from metadata", CACHE_DB_PATH)
+    os.remove(CACHE_DB_PATH)
+
+    TestCase().assertEqual(chunk_count, 1)
+
+
+def test_bulk_insert_splits_rows_into_batches():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE property_data (UPRN INTEGER PRIMARY KEY, Value TEXT)")
+    rows = [make_row(key) for key in KEYS]
+
+    bulk_insert(conn, "property_data", list(CACHE_FIELDS), rows, max_params=8)
+
+    result = conn.execute("select * from property_data order by UPRN").fetchall()
+    conn.close()
+
+    TestCase().assertEqual(result, rows)
+
+
+def test_get_max_params():
+    conn = sqlite3.connect(":memory:")
+    max_params = get_max_params(conn)
+    conn.close()
+
+    if hasattr(conn, "getlimit"):
+        TestCase().assertGreaterEqual(max_params, 999)
+    else:
+        TestCase().assertEqual(max_params, 999)
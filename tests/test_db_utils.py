@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import dataclasses
 import unittest
 import os
 import sqlite3
@@ -13,15 +14,41 @@ from ihutilities.db_utils import (
     configure_db,
     write_to_db,
     _make_connection,
+    _format_load_data_value,
+    _return_pooled_connection,
+    _clear_mysql_pool,
     read_db,
+    read_db_scalar,
     update_to_db,
     finalise_db,
+    indexes_disabled,
     check_mysql_database_exists,
     delete_from_db,
     delete_db,
+    open_db,
+    close_db,
 )
 
 
+class PositionalPingConnection:
+    """
+    Stands in for a MySQLdb connection, whose ping only takes its arguments positionally
+    """
+
+    def __init__(self):
+        self.pings = []
+        self.closed = False
+
+    def ping(self, reconnect=False, /):
+        self.pings.append(reconnect)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
 @unittest.skip("Not running MariaDB tests")
 class MariaDBUtilitiesTests(unittest.TestCase):
     @classmethod
@@ -105,6 +132,15 @@ class MariaDBUtilitiesTests(unittest.TestCase):
         rows = cursor.fetchall()
         self.assertEqual(data, rows)
 
+    def test_write_to_mariadb_with_load_data(self):
+        db_config = db_config_template.copy()
+        db_config["db_bulk_load"] = True
+        db_config = configure_db(db_config, self.db_fields, tables="test", force=True)
+        data = ((1, 2, "hello"), (2, None, 'Say "hi"'), (3, 3, "Beans"))
+        write_to_db(data, db_config, self.db_fields, table="test", bulk_method="load_data")
+        rows = tuple(tuple(x.values()) for x in read_db("select * from test;", db_config))
+        self.assertEqual(data, rows)
+
     def test_write_geom_to_mariadb(self):
         db_config = db_config_template.copy()
 
@@ -200,6 +236,25 @@ class DatabaseUtilitiesTests(unittest.TestCase):
         # if os.path.isfile(cls.db_file_path):
         #    os.remove(cls.db_file_path)
 
+    def test_pooled_and_kept_mysql_connections_with_positional_ping(self):
+        db_config = db_config_template.copy()
+        db_config["db_name"] = "positional_ping"
+        pooled_conn = PositionalPingConnection()
+        _return_pooled_connection(db_config, pooled_conn)
+        reused_conn = _make_connection(db_config)
+
+        kept_conn = PositionalPingConnection()
+        db_config["db_keep_open"] = True
+        db_config["db_conn"] = kept_conn
+        checked_conn = _make_connection(db_config)
+        db_config["db_conn"] = None
+        _clear_mysql_pool(db_config)
+
+        self.assertIs(reused_conn, pooled_conn)
+        self.assertEqual(pooled_conn.pings, [True])
+        self.assertIs(checked_conn, kept_conn)
+        self.assertEqual(kept_conn.pings, [True])
+
     def test_configure_db(self):
         db_filename = "test_config_db.sqlite"
         db_file_path = os.path.join(self.db_dir, db_filename)
@@ -289,6 +344,167 @@ class DatabaseUtilitiesTests(unittest.TestCase):
             rows = cursor.fetchall()
             self.assertEqual(data, rows)
 
+    def test_configure_db_keeps_existing_table(self):
+        db_filename = "test_write_db.sqlite"
+        db_file_path = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_file_path, self.db_fields, tables="test")
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+        configure_db(db_file_path, self.db_fields, tables="test")
+        with sqlite3.connect(db_file_path) as c:
+            rows = c.execute("select * from test;").fetchall()
+        self.assertEqual(data, rows)
+
+    def test_write_to_db_with_open_connection(self):
+        db_filename = "test_open_db.sqlite"
+        db_file_path = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_file_path, self.db_fields, tables="test")
+        db_config = open_db(db_file_path)
+        conn = db_config["db_conn"]
+        write_to_db(data[:2], db_config, self.db_fields, table="test")
+        write_to_db(data[2:], db_config, self.db_fields, table="test")
+        self.assertIs(conn, db_config["db_conn"])
+        rows = [tuple(x.values()) for x in read_db("select * from test;", db_config)]
+        close_db(db_config)
+
+        self.assertEqual(data, rows)
+        self.assertIsNone(db_config["db_conn"])
+
+    def test_write_to_db_rolls_back_written_chunks_on_error(self):
+        db_file_path = os.path.join(self.db_dir, "test_open_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        db_config = open_db(db_file_path)
+        # The first chunk is written before the short second row raises
+        data = [(3, 3, "c"), (4, 4)]
+        with self.assertRaises(sqlite3.ProgrammingError):
+            write_to_db(data, db_config, self.db_fields, table="test", chunk_size=1)
+        in_transaction = db_config["db_conn"].in_transaction
+        write_to_db([(1, 2, "hello")], db_config, self.db_fields, table="test")
+        rows = [tuple(x.values()) for x in read_db("select * from test;", db_config)]
+        close_db(db_config)
+
+        self.assertFalse(in_transaction)
+        self.assertEqual(rows, [(1, 2, "hello")])
+
+    def test_write_to_db_grouped_without_commit(self):
+        db_file_path = os.path.join(self.db_dir, "test_open_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_file_path, self.db_fields, tables="test")
+        db_config = open_db(db_file_path)
+        write_to_db(data[:2], db_config, self.db_fields, table="test", commit=False)
+        update_to_db([("Some", 2)], db_config, ["Addr1", "UPRN"], table="test", commit=False)
+        write_to_db(data[2:], db_config, self.db_fields, table="test", commit=False)
+        # Nothing is visible to another connection until the group is committed
+        uncommitted_count = read_db_scalar("select count(*) from test;", db_file_path)
+        db_config["db_conn"].commit()
+        close_db(db_config)
+
+        with sqlite3.connect(db_file_path) as c:
+            rows = c.execute("select * from test;").fetchall()
+        self.assertEqual(uncommitted_count, 0)
+        self.assertEqual(rows, [(1, 2, "hello"), (2, 3, "Some"), (3, 3, "Beans")])
+
+    def test_write_to_db_without_commit_needs_open_db(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        with self.assertRaises(ValueError):
+            write_to_db([(1, 2, "hello")], db_file_path, self.db_fields, table="test", commit=False)
+        with self.assertRaises(ValueError):
+            update_to_db([("Some", 1)], db_file_path, ["Addr1", "UPRN"], table="test", commit=False)
+
+    def test_write_to_db_in_chunks(self):
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        db_config = configure_db(":memory:", self.db_fields, tables="test")
+        write_to_db(data, db_config, self.db_fields, table="test", chunk_size=2)
+        in_transaction = db_config["db_conn"].in_transaction
+        rows = [tuple(x.values()) for x in read_db("select * from test;", db_config)]
+        close_db(db_config)
+
+        self.assertEqual(data, rows)
+        self.assertFalse(in_transaction)
+
+    def test_write_to_db_load_data_needs_mariadb(self):
+        db_file_path = os.path.join(self.db_dir, "test_write_db.sqlite")
+        with self.assertRaises(ValueError):
+            write_to_db([(1, 2, "hello")], db_file_path, self.db_fields, bulk_method="load_data")
+
+    def test_write_to_db_bad_bulk_method_leaves_no_lock(self):
+        db_file_path = os.path.join(self.db_dir, "test_open_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        configure_db(db_file_path, self.db_fields, tables="test")
+        db_config = open_db(db_file_path)
+        with self.assertRaises(ValueError):
+            write_to_db([(1, 2, "hello")], db_config, self.db_fields, table="test", bulk_method="x")
+        in_transaction = db_config["db_conn"].in_transaction
+        # Another connection can still write, so the write lock was never taken
+        with sqlite3.connect(db_file_path, timeout=0) as c:
+            c.execute("insert into test values (2, 3, 'Fred');")
+        close_db(db_config)
+
+        self.assertFalse(in_transaction)
+
+    def test_format_load_data_value(self):
+        values = [None, True, 3, 1.5, 'Say "hi"', "café", b'\x00"\xff']
+        formatted = [_format_load_data_value(x) for x in values]
+        self.assertEqual(
+            formatted,
+            [b"NULL", b"1", b"3", b"1.5", b'"Say ""hi"""', '"café"'.encode(), b'"\x00""\xff"'],
+        )
+
+    def test_open_db_with_bulk_load(self):
+        db_filename = "test_bulk_load.sqlite"
+        db_file_path = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        db_config = db_config_template.copy()
+        db_config["db_type"] = "sqlite"
+        db_config["db_path"] = db_file_path
+        db_config["db_bulk_load"] = True
+        db_config = open_db(configure_db(db_config, self.db_fields, tables="test"))
+        journal_mode = read_db_scalar("PRAGMA journal_mode;", db_config)
+        synchronous = read_db_scalar("PRAGMA synchronous;", db_config)
+        close_db(db_config)
+
+        self.assertEqual(journal_mode, "wal")
+        self.assertEqual(synchronous, 1)
+
+    def test_write_to_db_reconnects_lost_open_connection(self):
+        db_filename = "test_open_db_reconnect.sqlite"
+        db_file_path = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_file_path, self.db_fields, tables="test")
+        db_config = open_db(db_file_path)
+        db_config["db_conn"].close()
+        write_to_db(data, db_config, self.db_fields, table="test")
+        rows = [tuple(x.values()) for x in read_db("select * from test;", db_config)]
+        close_db(db_config)
+
+        self.assertEqual(data, rows)
+
+    def test_write_to_memory_db(self):
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        db_config = configure_db(":memory:", self.db_fields, tables="test")
+        write_to_db(data, db_config, self.db_fields, table="test")
+        rows = [tuple(x.values()) for x in read_db("select * from test;", db_config)]
+        close_db(db_config)
+
+        self.assertEqual(data, rows)
+        self.assertFalse(os.path.isfile(":memory:"))
+
     def test_delete_from_db(self):
         db_filename = "test_delete_from_db.sqlite"
         db_file_path = os.path.join(self.db_dir, db_filename)
@@ -310,6 +526,21 @@ class DatabaseUtilitiesTests(unittest.TestCase):
             rows = cursor.fetchall()
             self.assertEqual(data[1:], rows)
 
+    def test_write_dataclasses_to_db(self):
+        @dataclasses.dataclass
+        class Address:
+            UPRN: int
+            PropertyID: int
+            Addr1: str
+
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        db_config = configure_db(":memory:", self.db_fields, tables="test")
+        write_to_db([Address(*row) for row in data], db_config, self.db_fields, table="test")
+        rows = [tuple(x.values()) for x in read_db("select * from test;", db_config)]
+        close_db(db_config)
+
+        self.assertEqual(data, rows)
+
     def test_write_dictionaries_to_db(self):
         db_filename = "test_write_db.sqlite"
         db_file_path = os.path.join(self.db_dir, db_filename)
@@ -357,6 +588,19 @@ class DatabaseUtilitiesTests(unittest.TestCase):
             expected = ("Some",)
             self.assertEqual(expected, rows[0])
 
+    def test_update_to_db_with_mixed_none_fields(self):
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        db_config = configure_db(":memory:", self.db_fields, tables="test")
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        update_fields = ["PropertyID", "Addr1", "UPRN"]
+        update = [(5, None, 1), (None, "Some", 2), (6, "Other", 3), (7, None, 1)]
+        update_to_db(update, db_config, update_fields, table="test", key="UPRN")
+        rows = [tuple(x.values()) for x in read_db("select * from test;", db_config)]
+        close_db(db_config)
+
+        self.assertEqual([(1, 7, "hello"), (2, 3, "Some"), (3, 6, "Other")], rows)
+
     def test_update_to_db_compound_key(self):
         db_filename = "test_update_db.sqlite"
         db_file_path = os.path.join(self.db_dir, db_filename)
@@ -381,6 +625,28 @@ class DatabaseUtilitiesTests(unittest.TestCase):
             expected = ("Some",)
             self.assertEqual(expected, rows[0])
 
+    def test_update_to_db_rolls_back_earlier_groups_on_error(self):
+        db_file_path = os.path.join(self.db_dir, "test_update_db.sqlite")
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_file_path, self.db_fields, tables="test", force=True)
+        write_to_db(data, db_file_path, self.db_fields, table="test")
+        db_config = open_db(db_file_path)
+
+        # The rows set different fields so they are separate groups, the second cannot be bound
+        update_fields = ["Addr1", "PropertyID", "UPRN"]
+        update = [("Some", None, 3), (None, [4], 2)]
+        with self.assertRaises(sqlite3.Error):
+            update_to_db(update, db_config, update_fields, table="test", key="UPRN")
+        in_transaction = db_config["db_conn"].in_transaction
+        write_to_db([(4, 4, "More")], db_config, self.db_fields, table="test")
+        close_db(db_config)
+
+        addr1 = read_db_scalar("select Addr1 from test where UPRN = 3;", db_file_path)
+        self.assertFalse(in_transaction)
+        self.assertEqual(addr1, "Beans")
+
     def test_update_dictionaries_to_db(self):
         db_filename = "test_update_db.sqlite"
         db_file_path = os.path.join(self.db_dir, db_filename)
@@ -461,6 +727,24 @@ class DatabaseUtilitiesTests(unittest.TestCase):
         write_to_db(data, db_file_path, self.db_fields, table="test")
         finalise_db(db_file_path, index_name="idx_addr1", table="test", colname="Addr1")
 
+    def test_indexes_disabled(self):
+        db_filename = "test_finalise_db.sqlite"
+        db_file_path = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_file_path, self.db_fields, tables="test")
+        finalise_db(db_file_path, index_name="idx_addr1", table="test", colname="Addr1")
+        index_query = "select name from sqlite_master where type = 'index' and sql is not null"
+
+        with indexes_disabled(db_file_path, table="test"):
+            write_to_db(data, db_file_path, self.db_fields, table="test")
+            indexes_during = list(read_db(index_query, db_file_path))
+
+        indexes_after = list(read_db(index_query, db_file_path))
+        self.assertEqual(indexes_during, [])
+        self.assertEqual(indexes_after, [{"name": "idx_addr1"}])
+
     def test_read_db(self):
         db_filename = "test_finalise_db.sqlite"
         db_config = os.path.join(self.db_dir, db_filename)
@@ -476,6 +760,40 @@ class DatabaseUtilitiesTests(unittest.TestCase):
             test_data = OrderedDict(zip(self.db_fields.keys(), data[i]))
             self.assertEqual(row, test_data)
 
+    def test_interleaved_read_db_on_one_config(self):
+        db_filename = "test_finalise_db.sqlite"
+        db_file_path = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_file_path):
+            os.remove(db_file_path)
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        db_config = configure_db(db_file_path, self.db_fields, tables="test")
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        first = read_db("select UPRN from test;", db_config)
+        second = read_db("select Addr1 from test;", db_config)
+        first_rows = [next(first)]
+        second_rows = [next(second)]
+        # Finishing the first generator must close its own connection, not the second's
+        first_rows.extend(first)
+        second_rows.extend(second)
+
+        self.assertEqual([row["UPRN"] for row in first_rows], [1, 2, 3])
+        self.assertEqual([row["Addr1"] for row in second_rows], ["hello", "Fred", "Beans"])
+
+    def test_read_db_scalar(self):
+        db_filename = "test_read_db_scalar.sqlite"
+        db_config = os.path.join(self.db_dir, db_filename)
+        if os.path.isfile(db_config):
+            os.remove(db_config)
+        data = [(1, 2, "hello"), (2, 3, "Fred"), (3, 3, "Beans")]
+        configure_db(db_config, self.db_fields, tables="test")
+        write_to_db(data, db_config, self.db_fields, table="test")
+
+        self.assertEqual(read_db_scalar("select count(*) from test;", db_config), 3)
+        sql_query = "select Addr1 from test where UPRN = {};"
+        self.assertEqual(read_db_scalar(sql_query.format(2), db_config), "Fred")
+        self.assertIsNone(read_db_scalar(sql_query.format(4), db_config))
+
     def test_read_db_doesnot_create_database(self):
         db_filename = "nonexistent_db.sqlite"
         db_config = os.path.join(self.db_dir, db_filename)
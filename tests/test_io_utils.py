@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import hashlib
 import os
 import unittest
 import sys
@@ -18,11 +19,13 @@ from ihutilities.io_utils import (
     split_uri,
     join_paths_local_or_s3,
     write_dictionary,
+    DictCsvAppender,
     list_files_local_or_s3,
     expand_file_path,
+    MMAP_SHA_THRESHOLD,
 )
 
-from ihutilities import git_calculate_file_sha, calculate_file_sha
+from ihutilities import git_calculate_file_sha, calculate_file_sha, calculate_file_shas
 
 PP_REFERENCE_DATA_DIRECTORY = os.path.join(
     Path(__file__).parents[0], "fixtures", "land-registry-price-paid"
@@ -60,6 +63,55 @@ class ShaCalculationTests(unittest.TestCase):
         self.assertEqual(git_calculate_file_sha(norm_path), calculate_file_sha(norm_path))
 
 
+def test_calculate_file_shas_matches_calculate_file_sha():
+    fixtures = os.path.join(Path(__file__).parents[0], "fixtures")
+    filepaths = [
+        os.path.join(fixtures, "survey_csv.csv"),
+        os.path.join(fixtures, "survey_csv.zip/survey_csv.csv"),
+        os.path.join(fixtures, "does_not_exist.csv"),
+    ]
+
+    file_shas = calculate_file_shas(filepaths, max_workers=2)
+
+    TestCase().assertEqual(list(file_shas.keys()), filepaths)
+    for filepath in filepaths:
+        TestCase().assertEqual(file_shas[filepath], calculate_file_sha(filepath))
+
+
+def test_calculate_file_sha_is_the_same_for_read_and_memory_mapped_files():
+    temp_dir = os.path.join(Path(__file__).parents[0], "temp")
+    large_file_path = os.path.join(temp_dir, "large_sha_test_file")
+    small_file_path = os.path.join(temp_dir, "small_sha_test_file")
+    # The large file is memory mapped, the small one with the same start is read
+    large_content = b"0123456789abcdef\n" * 8192
+    small_content = large_content[: MMAP_SHA_THRESHOLD - 1]
+    with open(large_file_path, "wb") as large_file:
+        large_file.write(large_content)
+    with open(small_file_path, "wb") as small_file:
+        small_file.write(small_content)
+
+    large_sha = calculate_file_sha(large_file_path)
+    small_sha = calculate_file_sha(small_file_path)
+    os.remove(large_file_path)
+    os.remove(small_file_path)
+
+    TestCase().assertGreaterEqual(len(large_content), MMAP_SHA_THRESHOLD)
+    for file_sha, content in [(large_sha, large_content), (small_sha, small_content)]:
+        expected_sha = hashlib.sha1(
+            "blob {:d}\0".format(len(content)).encode("utf-8") + content
+        ).hexdigest()
+        TestCase().assertEqual(file_sha, expected_sha)
+
+
+def test_calculate_file_sha_labels_other_algorithms():
+    filepath = os.path.join(Path(__file__).parents[0], "fixtures", "sha_test_file")
+
+    file_sha = calculate_file_sha(filepath, algorithm="sha256")
+
+    TestCase().assertTrue(file_sha.startswith("sha256:"))
+    TestCase().assertEqual(len(file_sha), len("sha256:") + 64)
+
+
 def test_write_dictionary_raises_an_index_error():
     TestCase().assertRaises(IndexError, write_dictionary, TEMP_FILE_PATH, [])
 
@@ -81,6 +133,21 @@ def test_write_dictionary_to_local_file():
     TestCase().assertIn("is being created", status)
 
 
+def test_dict_csv_appender_writes_one_header():
+    if os.path.isfile(TEMP_FILE_PATH):
+        os.remove(TEMP_FILE_PATH)
+
+    with DictCsvAppender(TEMP_FILE_PATH, ["a", "b", "c"]) as appender:
+        appender.writerows(DICT_LIST)
+        appender.writerow(DICT_LIST[0])
+    status = write_dictionary(TEMP_FILE_PATH, DICT_LIST[1:])
+    rows_read = list(iterator_from_filepath(TEMP_FILE_PATH))
+
+    TestCase().assertEqual(len(rows_read), 6)
+    TestCase().assertDictEqual(rows_read[3], {"a": "1", "b": "2", "c": "3"})
+    TestCase().assertIn("data is being appended", status)
+
+
 @mock_s3
 def test_write_dictionary_to_s3():
     filename = "tmp.csv"
@@ -165,7 +232,7 @@ def test_list_files_local():
 
     files = list_files_local_or_s3(f"{file_directory}/*.py")
 
-    TestCase().assertEqual(len(files), 10)
+    TestCase().assertEqual(len(files), 11)
 
 
 @mock_s3